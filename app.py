@@ -1,11 +1,32 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, send_file, Response, stream_with_context, g, has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from markupsafe import Markup, escape
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime
 import os
-import io
+import re
+import math
+import json
+import time
+import uuid
+import functools
+import hashlib
+import hmac
+import atexit
+import tempfile
+import threading
+import itertools
+import multiprocessing
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
 
 # --- CONFIGURAZIONE ---
 app = Flask(__name__)
@@ -18,7 +39,22 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,   # testa la connessione prima di usarla
     "pool_recycle": 280,     # ricicla connessioni ogni ~5 min
 }
+if not _db_url.startswith("sqlite"):
+    # Pool per processo dimensionato sui thread del worker gunicorn (GUNICORN_THREADS, vedi
+    # gunicorn.conf.py): una connessione per thread, più un margine per i thread in background
+    # (export, conferme di lettura). Connessioni massime verso Postgres ≈ worker × (size + overflow).
+    _threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update({
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", _threads)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", int(os.environ.get("EXPORT_WORKERS", "2")) + 1)),
+        "pool_timeout": 10,  # meglio un 500 veloce che richieste appese a un pool esaurito
+    })
 app.secret_key = os.environ.get("SECRET_KEY", "devsecret")
+# Dietro il proxy di Render remote_addr è il proxy: con TRUSTED_PROXIES=1 si usa X-Forwarded-For
+if int(os.environ.get("TRUSTED_PROXIES", "0")) > 0:
+    _proxies = int(os.environ["TRUSTED_PROXIES"])
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=_proxies, x_proto=_proxies)
+app.config["PAGE_SIZE"] = int(os.environ.get("PAGE_SIZE", "50"))  # ticket per pagina
 
 # DEBUG: stampa database usato
 print("📦 DATABASE CONNESSO:", app.config["SQLALCHEMY_DATABASE_URI"])
@@ -26,6 +62,20 @@ print("📦 DATABASE CONNESSO:", app.config["SQLALCHEMY_DATABASE_URI"])
 db = SQLAlchemy(app)
 
 # --- MODELLI ---
+def problem_fingerprint(cinema, sala, tipo, autore, data_ora):
+    """Hash del contenuto di un ticket, stabile tra export e re-import.
+
+    data_ora è troncata al minuto come nel formato dei fogli Excel.
+    """
+    key = "\x1f".join([
+        (cinema or "").strip().casefold(),
+        str(sala or "").strip(),
+        (tipo or "").strip(),
+        (autore or "").strip().casefold(),
+        data_ora.strftime("%Y%m%d%H%M") if data_ora else "",
+    ])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
 class User(db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
@@ -42,7 +92,8 @@ class User(db.Model):
 class Problem(db.Model):
     __tablename__ = "problems"
     id = db.Column(db.Integer, primary_key=True)
-    cinema = db.Column(db.String(100), nullable=False)
+    cinema = db.Column(db.String(100), nullable=False)  # nome per la visualizzazione
+    cinema_id = db.Column(db.Integer, db.ForeignKey("cinemas.id", ondelete="SET NULL"), nullable=True)
     città = db.Column(db.String(100), nullable=False, default="")
     sala = db.Column(db.String(20), nullable=False, default="1")
     tipo = db.Column(db.Text, nullable=False)
@@ -52,8 +103,35 @@ class Problem(db.Model):
     chiuso_il = db.Column(db.DateTime, nullable=True)
     autore = db.Column(db.String(80), nullable=False)
     data_ora = db.Column(db.DateTime, default=datetime.utcnow)
+    # Contatori chat denormalizzati (mantenuti da add_comment)
+    comment_count   = db.Column(db.Integer, nullable=False, default=0)
+    last_comment_at = db.Column(db.DateTime, nullable=True)
+    # Ultima modifica del ticket: versione dei dati per cache export
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Impronta del contenuto (cinema, sala, tipo, autore, data_ora): dedup negli import
+    fingerprint = db.Column(db.String(64), nullable=True, index=True)
     comments = db.relationship("Comment", backref="problem", cascade="all, delete-orphan", lazy=True)
 
+    # Indici per i filtri caldi: dashboard (stato != 'Chiuso', autore) e archivio
+    # (stato = 'Chiuso'), sempre ordinati per (data_ora, id) come la paginazione keyset.
+    # Gli indici parziali sui ticket aperti servono perché "!=" non usa un indice su stato.
+    __table_args__ = (
+        db.Index("ix_problems_stato_autore_data", "stato", "autore", "data_ora", "id"),
+        db.Index("ix_problems_stato_data", "stato", "data_ora", "id"),
+        db.Index("ix_problems_autore_updated", "autore", "updated_at"),
+        db.Index("ix_problems_updated", "updated_at"),
+        db.Index("ix_problems_cinema_stato", "cinema_id", "stato"),
+        db.Index("ix_problems_open_data", "data_ora", "id",
+                 postgresql_where=db.text("stato <> 'Chiuso'"),
+                 sqlite_where=db.text("stato <> 'Chiuso'")),
+        db.Index("ix_problems_open_autore_data", "autore", "data_ora", "id",
+                 postgresql_where=db.text("stato <> 'Chiuso'"),
+                 sqlite_where=db.text("stato <> 'Chiuso'")),
+    )
+
+    def update_fingerprint(self):
+        self.fingerprint = problem_fingerprint(self.cinema, self.sala, self.tipo, self.autore, self.data_ora)
+
     def __repr__(self):
         return f"<Problem {self.id} - {self.tipo[:20]}>"
 
@@ -65,11 +143,12 @@ class Comment(db.Model):
     role = db.Column(db.String(20), nullable=False, default="user")
     testo = db.Column(db.Text, nullable=False)
     data_ora = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index("ix_comments_problem_data", "problem_id", "data_ora"),)
 
 class Cinema(db.Model):
     __tablename__ = "cinemas"
     id = db.Column(db.Integer, primary_key=True)
-    nome = db.Column(db.String(100), nullable=False)
+    nome = db.Column(db.String(100), nullable=False, index=True)
     città = db.Column(db.String(100), nullable=False, default="")
     num_sale = db.Column(db.Integer, nullable=False, default=1)
     telefono = db.Column(db.String(50), default="")
@@ -92,6 +171,7 @@ class TicketRead(db.Model):
     user_id = db.Column(db.Integer, nullable=False)
     problem_id = db.Column(db.Integer, nullable=False)
     last_read_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # uq_user_problem fa anche da indice per il lookup (user_id, problem_id)
     __table_args__ = (db.UniqueConstraint("user_id", "problem_id", name="uq_user_problem"),)
 
 class UserCinema(db.Model):
@@ -101,12 +181,66 @@ class UserCinema(db.Model):
     cinema_id = db.Column(db.Integer, db.ForeignKey("cinemas.id", ondelete="CASCADE"), nullable=False)
     __table_args__ = (db.UniqueConstraint("user_id", "cinema_id", name="uq_user_cinema"),)
 
-# --- CREAZIONE AUTOMATICA TABELLE + MIGRAZIONI ---
-with app.app_context():
-    db.create_all()
-
-    # Migrazione colonne mancanti (ALTER TABLE sicuro)
-    _migrations = [
+class ImportCheckpoint(db.Model):
+    """Ultima riga importata per (file, foglio): un import interrotto riprende da qui."""
+    __tablename__ = "import_checkpoints"
+    id = db.Column(db.Integer, primary_key=True)
+    file_hash = db.Column(db.String(64), nullable=False)
+    sheet = db.Column(db.String(100), nullable=False)
+    last_row = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint("file_hash", "sheet", name="uq_import_checkpoint"),)
+
+class CatalogVersion(db.Model):
+    """Contatore di versione condiviso tra i worker per invalidare le cache in processo."""
+    __tablename__ = "catalog_versions"
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class TicketEvent(db.Model):
+    """Registro append-only delle modifiche ai ticket: l'id è il cursore di /api/events."""
+    __tablename__ = "ticket_events"
+    id = db.Column(db.Integer, primary_key=True)
+    problem_id = db.Column(db.Integer, nullable=False, index=True)  # senza FK: resta dopo "eliminato"
+    tipo = db.Column(db.String(20), nullable=False)  # creato, aggiornato, commento, eliminato
+    autore = db.Column(db.String(80), nullable=False, default="")
+    data_ora = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    dati = db.Column(db.JSON, nullable=False, default=dict)
+
+class SchemaVersion(db.Model):
+    """Migrazioni applicate (una riga per versione, vedi flask db-upgrade)."""
+    __tablename__ = "schema_version"
+    version = db.Column(db.Integer, primary_key=True)
+    descrizione = db.Column(db.String(200), nullable=False, default="")
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# --- MIGRAZIONI VERSIONATE ---
+# Eseguite una sola volta per deploy con `flask db-upgrade` (non all'import in ogni worker).
+# Ogni migrazione è idempotente: su un DB creato prima di schema_version vengono
+# riapplicate tutte senza effetti sui dati già migrati.
+_MIGRATIONS = []
+
+def _migration(version, descrizione):
+    def decorator(fn):
+        _MIGRATIONS.append((version, descrizione, fn))
+        return fn
+    return decorator
+
+def _add_column_if_missing(conn, table, col, col_def):
+    existing = {c["name"] for c in db.inspect(conn).get_columns(table)}
+    if col in existing:
+        return False
+    conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN "{col}" {col_def}'))
+    print(f"✅ Migrazione: {table}.{col} aggiunta")
+    return True
+
+@_migration(1, "tabelle base")
+def _m001_create_tables(conn):
+    db.metadata.create_all(conn)
+
+@_migration(2, "colonne legacy (città, sale, contatti, chiusura)")
+def _m002_legacy_columns(conn):
+    for table, col, col_def in [
         ("problems", "città",    "VARCHAR(100) NOT NULL DEFAULT ''"),
         ("problems", "sala",     "VARCHAR(20)  NOT NULL DEFAULT '1'"),
         ("cinemas",  "città",    "VARCHAR(100) NOT NULL DEFAULT ''"),
@@ -120,92 +254,419 @@ with app.app_context():
         ("users",    "password_plain", "VARCHAR(200) NOT NULL DEFAULT ''"),
         ("problems", "chiuso_da",      "VARCHAR(80)"),
         ("problems", "chiuso_il",      "TIMESTAMP"),
-    ]
-    with db.engine.connect() as conn:
-        for table, col, col_def in _migrations:
-            try:
-                conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN "{col}" {col_def}'))
-                conn.commit()
-                print(f"✅ Migrazione: {table}.{col} aggiunta")
-            except Exception:
-                conn.rollback()  # colonna già presente, ignora
+    ]:
+        _add_column_if_missing(conn, table, col, col_def)
+
+@_migration(3, "contatori chat denormalizzati")
+def _m003_comment_counters(conn):
+    added = _add_column_if_missing(conn, "problems", "comment_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(conn, "problems", "last_comment_at", "TIMESTAMP")
+    if added:
+        conn.execute(db.text(
+            "UPDATE problems SET "
+            "comment_count = (SELECT COUNT(*) FROM comments WHERE comments.problem_id = problems.id), "
+            "last_comment_at = (SELECT MAX(comments.data_ora) FROM comments WHERE comments.problem_id = problems.id)"
+        ))
+        print("✅ Migrazione: contatori chat calcolati")
+
+def _create_indexes(conn, *names):
+    """Crea (se mancano) gli indici dei modelli indicati per nome.
+
+    create_all crea gli indici solo per le tabelle nuove: sulle tabelle
+    esistenti ogni migrazione crea esplicitamente i propri.
+    """
+    wanted = set(names)
+    for table in db.metadata.sorted_tables:
+        for idx in table.indexes:
+            if idx.name in wanted:
+                idx.create(conn, checkfirst=True)
+
+@_migration(4, "indici per dashboard, archivio, chat e cinema")
+def _m004_indexes(conn):
+    _create_indexes(conn, "ix_problems_stato_autore_data", "ix_problems_stato_data",
+                    "ix_problems_open_data", "ix_problems_open_autore_data",
+                    "ix_comments_problem_data", "ix_cinemas_nome")
+
+@_migration(5, "problems.updated_at per versionare i dati esportati")
+def _m005_updated_at(conn):
+    if _add_column_if_missing(conn, "problems", "updated_at", "TIMESTAMP"):
+        conn.execute(db.text("UPDATE problems SET updated_at = COALESCE(chiuso_il, data_ora)"))
+    _create_indexes(conn, "ix_problems_autore_updated", "ix_problems_updated")
+
+@_migration(6, "checkpoint per import Excel a blocchi")
+def _m006_import_checkpoints(conn):
+    ImportCheckpoint.__table__.create(conn, checkfirst=True)
+
+@_migration(7, "impronta contenuto dei ticket per dedup import")
+def _m007_fingerprint(conn):
+    _add_column_if_missing(conn, "problems", "fingerprint", "VARCHAR(64)")
+    _create_indexes(conn, "ix_problems_fingerprint")
+    _fill_missing_fingerprints(conn)
+
+def _fill_missing_fingerprints(conn):
+    """Calcola l'impronta dove manca, a blocchi per id, senza caricare la tabella in memoria."""
+    t = Problem.__table__
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            db.select(t.c.id, t.c.cinema, t.c.sala, t.c.tipo, t.c.autore, t.c.data_ora)
+            .where(t.c.id > last_id, t.c.fingerprint.is_(None))
+            .order_by(t.c.id).limit(1000)
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            # updated_at esplicito: l'impronta non è una modifica del ticket (niente onupdate)
+            t.update().where(t.c.id == db.bindparam("pid"))
+            .values(fingerprint=db.bindparam("fp"), updated_at=t.c.updated_at),
+            [{"pid": r.id, "fp": problem_fingerprint(r.cinema, r.sala, r.tipo, r.autore, r.data_ora)}
+             for r in rows],
+        )
+        last_id = rows[-1].id
+
+def _link_problems_to_cinemas(conn):
+    """Collega a cinemas.id i ticket senza cinema_id, per nome."""
+    conn.execute(db.text(
+        "UPDATE problems SET cinema_id = "
+        "(SELECT MIN(cinemas.id) FROM cinemas WHERE cinemas.nome = TRIM(problems.cinema)) "
+        "WHERE cinema_id IS NULL "
+        "AND EXISTS (SELECT 1 FROM cinemas WHERE cinemas.nome = TRIM(problems.cinema))"
+    ))
+
+@_migration(8, "contatore versione catalogo cinema")
+def _m008_catalog_versions(conn):
+    CatalogVersion.__table__.create(conn, checkfirst=True)
+    exists = conn.execute(db.select(CatalogVersion.name).where(CatalogVersion.name == "cinemas")).first()
+    if not exists:
+        conn.execute(db.insert(CatalogVersion).values(name="cinemas", version=0))
+
+@_migration(9, "problems.cinema_id (FK verso cinemas) dai nomi")
+def _m009_cinema_fk(conn):
+    _add_column_if_missing(conn, "problems", "cinema_id",
+                           "INTEGER REFERENCES cinemas(id) ON DELETE SET NULL")
+    _link_problems_to_cinemas(conn)
+    _create_indexes(conn, "ix_problems_cinema_stato")
+
+@_migration(10, "indice full-text su ticket e chat")
+def _m010_fulltext(conn):
+    # PostgreSQL: tsvector generato (si aggiorna da solo a ogni INSERT/UPDATE) + GIN.
+    # SQLite: tabelle FTS5 "external content" allineate da trigger, riempite una volta.
+    if conn.dialect.name == "postgresql":
+        for table, col in (("problems", "tipo"), ("comments", "testo")):
+            conn.execute(db.text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', coalesce({col}, ''))) STORED"
+            ))
+            conn.execute(db.text(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING GIN (search_vector)"
+            ))
+        return
+    for table, col in (("problems", "tipo"), ("comments", "testo")):
+        fts = f"{table}_fts"
+        exists = conn.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :n"), {"n": fts}).first()
+        conn.exec_driver_sql(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            f"{col}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {col}) VALUES (new.id, new.{col}); END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.id, old.{col}); END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {col} ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.id, old.{col}); "
+            f"INSERT INTO {fts}(rowid, {col}) VALUES (new.id, new.{col}); END"
+        )
+        if not exists:
+            conn.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+@_migration(11, "registro eventi dei ticket (feed /api/events)")
+def _m011_ticket_events(conn):
+    TicketEvent.__table__.create(conn, checkfirst=True)
+
+def _backfill_cinemas_from_problems(conn):
+    """Crea i cinema citati dai ticket ma assenti dal catalogo (esclusi gli eliminati) e li collega.
+
+    Legge i nomi distinti di tutta la tabella problems: non va eseguita a ogni avvio,
+    solo dalla migrazione 12 o a mano con `flask backfill-cinemas`.
+    """
+    known = set(conn.execute(db.select(Cinema.nome)).scalars())
+    known |= set(conn.execute(db.select(DeletedCinema.nome)).scalars())
+    nomi = conn.execute(
+        db.select(db.func.trim(Problem.cinema)).where(Problem.cinema != "").distinct()
+    ).scalars()
+    rows = [{"nome": nome, "città": "", "num_sale": 1} for nome in nomi if nome and nome not in known]
+    if rows:
+        conn.execute(db.insert(Cinema), rows)
+    _link_problems_to_cinemas(conn)
+    if rows:
+        conn.execute(
+            db.update(CatalogVersion).where(CatalogVersion.name == "cinemas")
+            .values(version=CatalogVersion.version + 1)
+        )
+    return len(rows)
+
+@_migration(12, "cinema citati dai ticket ma non in catalogo")
+def _m012_backfill_cinemas(conn):
+    backfilled = _backfill_cinemas_from_problems(conn)
+    if backfilled:
+        print(f"✅ {backfilled} cinema recuperati dai ticket")
+
+def _upgrade_db():
+    """Applica in ordine le migrazioni non ancora registrate in schema_version."""
+    with db.engine.begin() as conn:
+        SchemaVersion.__table__.create(conn, checkfirst=True)
+        current = conn.execute(db.select(db.func.max(SchemaVersion.version))).scalar() or 0
+    applied = 0
+    for version, descrizione, fn in sorted(_MIGRATIONS, key=lambda m: m[0]):
+        if version <= current:
+            continue
+        with db.engine.begin() as conn:
+            fn(conn)
+            conn.execute(db.insert(SchemaVersion).values(version=version, descrizione=descrizione))
+        print(f"✅ Schema v{version}: {descrizione}")
+        applied += 1
+    return applied
+
+# --- SEED ---
+CINEMAS_SEED = [
+    {"nome": "Cinema Chiusi",                        "città": "Chiusi",                   "num_sale": 6, "telefono": "0578 275077", "indirizzo": "Loc. Querce al Pino, SP 146, 53043 Chiusi SI",         "lat": 43.0025, "lng": 11.9481},
+    {"nome": "Cinema Empoli",                        "città": "Empoli",                   "num_sale": 3, "telefono": "0571 72023",  "indirizzo": "Via Cosimo Ridolfi 75, 50053 Empoli FI",              "lat": 43.7208, "lng": 10.9478},
+    {"nome": "Cinema Firenze",                       "città": "Firenze",                  "num_sale": 1, "telefono": "055 483607",  "indirizzo": "Via G. Romagnosi 46, 50134 Firenze FI",               "lat": 43.7835, "lng": 11.2427},
+    {"nome": "Cinema Odeon",                         "città": "Firenze",                  "num_sale": 1, "telefono": "055 214068",  "indirizzo": "Piazza degli Strozzi 2, 50123 Firenze FI",            "lat": 43.7711, "lng": 11.2519},
+    {"nome": "Cinema Grosseto",                      "città": "Grosseto",                 "num_sale": 4, "telefono": "0564 27069",  "indirizzo": "Via Goffredo Mameli 24, 58100 Grosseto GR",           "lat": 42.7641, "lng": 11.1086},
+    {"nome": "Cinema Massa",                         "città": "Massa",                    "num_sale": 7, "telefono": "0585 791105", "indirizzo": "Via Dorsale 11, 54100 Massa MS",                      "lat": 44.0181, "lng": 10.1327},
+    {"nome": "Cinema Montecatini",                   "città": "Montecatini Terme",        "num_sale": 4, "telefono": "0572 78510",  "indirizzo": "Piazza Massimo D'Azeglio 5, 51016 Montecatini Terme PT", "lat": 43.8849, "lng": 10.7722},
+    {"nome": "Cinema Pisa",                          "città": "Pisa",                     "num_sale": 3, "telefono": "050 5552261", "indirizzo": "Via Piave 47, 56123 Pisa PI",                         "lat": 43.7155, "lng": 10.3986},
+    {"nome": "Cinecity Pisa",                        "città": "Pisa",                     "num_sale": 5, "telefono": "392 323 3535","indirizzo": "Piazza della Stazione 16, 56125 Pisa PI",             "lat": 43.7090, "lng": 10.3972},
+    {"nome": "Cinema Sansepolcro",                   "città": "Sansepolcro",              "num_sale": 1, "telefono": "0575 733433", "indirizzo": "Via XX Settembre 156, 52037 Sansepolcro AR",           "lat": 43.5695, "lng": 12.1406},
+    {"nome": "ELIA ANTICA MULTISALA",                "città": "Grosseto",                 "num_sale": 4, "telefono": "0564 644987", "indirizzo": "Via Aurelia Antica 46, 58100 Grosseto GR",            "lat": 42.7548, "lng": 11.0931},
+    {"nome": "Cinema Scuderie Granducali Seravezza", "città": "Seravezza",                "num_sale": 1, "telefono": "0584 840409", "indirizzo": "Viale Leonetto Amedei 124, 55047 Seravezza LU",       "lat": 43.9962, "lng": 10.2321},
+    {"nome": "Teatro Cinema Giotto",                 "città": "Borgo San Lorenzo",        "num_sale": 1, "telefono": "055 845 9658","indirizzo": "Corso Giacomo Matteotti 151, 50032 Borgo San Lorenzo FI", "lat": 43.9548, "lng": 11.3855},
+    {"nome": "Cinema Metropolitan",                  "città": "Piombino",                 "num_sale": 1, "telefono": "0565 30385",  "indirizzo": "Piazza Cappelletti 2, 57025 Piombino LI",             "lat": 42.9225, "lng": 10.5320},
+    {"nome": "Cinema Multisala Excelsior",           "città": "Montecatini Terme",        "num_sale": 2, "telefono": "0572 904289", "indirizzo": "Viale Giuseppe Verdi 66, 51016 Montecatini Terme PT", "lat": 43.8825, "lng": 10.7740},
+    {"nome": "Cinema Teatro Scipione Ammirato",      "città": "Montaione",                "num_sale": 1, "telefono": "0571 61517",  "indirizzo": "Piazza Gramsci 2, 50050 Montaione FI",                "lat": 43.5595, "lng": 10.9126},
+    {"nome": "Multisala Isola Verde",                "città": "Pisa",                     "num_sale": 3, "telefono": "050 973676",  "indirizzo": "Via Vittorio Frascani, 56124 Pisa PI",                "lat": 43.7024, "lng": 10.3912},
+    {"nome": "Cinema Sala Esse",                     "città": "Firenze",                  "num_sale": 1, "telefono": "055 666643",  "indirizzo": "Via del Ghirlandaio 38, 50121 Firenze FI",            "lat": 43.7697, "lng": 11.2763},
+    {"nome": "Multisala Goldoni",                    "città": "Viareggio",                "num_sale": 2, "telefono": "0584 49832",  "indirizzo": "Via San Francesco 124, 55049 Viareggio LU",           "lat": 43.8682, "lng": 10.2547},
+    {"nome": "Cinema Multisala Il Portico",          "città": "Firenze",                  "num_sale": 2, "telefono": "055 669930",  "indirizzo": "Via Capo di Mondo 66, 50136 Firenze FI",              "lat": 43.7698, "lng": 11.2919},
+    {"nome": "Cinema Teatro Everest Galluzzo",       "città": "Firenze",                  "num_sale": 1, "telefono": "055 232 1754","indirizzo": "Via Volterrana 4, 50124 Firenze FI",                  "lat": 43.7388, "lng": 11.2413},
+    {"nome": "Spazio Alfieri Cinema Teatro Bistrò",  "città": "Firenze",                  "num_sale": 1, "telefono": "055 5320840", "indirizzo": "Via dell'Ulivo 8, 50122 Firenze FI",                  "lat": 43.7703, "lng": 11.2639},
+    {"nome": "Cinema Teatro Multisala Imperiale",    "città": "Montecatini Terme",        "num_sale": 4, "telefono": "0572 508601", "indirizzo": "Piazza Massimo D'Azeglio 5, 51016 Montecatini Terme PT", "lat": 43.8849, "lng": 10.7722},
+    {"nome": "Cinema Centrale",                      "città": "Viareggio",                "num_sale": 1, "telefono": "0584 581226", "indirizzo": "Via Cesare Battisti 67, 55049 Viareggio LU",          "lat": 43.8707, "lng": 10.2534},
+    {"nome": "Cinema Nuova Aurora",                  "città": "Sansepolcro",              "num_sale": 1, "telefono": "0575 1480629","indirizzo": "Via Piero della Francesca 47, 52037 Sansepolcro AR",  "lat": 43.5696, "lng": 12.1393},
+    {"nome": "Cinema Marconi",                       "città": "Firenze",                  "num_sale": 3, "telefono": "055 680554",  "indirizzo": "Viale Giannotti 45r, 50126 Firenze FI",               "lat": 43.7526, "lng": 11.2694},
+    {"nome": "Multisala Splendor",                   "città": "Massa",                    "num_sale": 7, "telefono": "0585 791105", "indirizzo": "Via Dorsale 11, 54100 Massa MS",                      "lat": 44.0181, "lng": 10.1327},
+    {"nome": "Teatro dei Servi",                     "città": "Massa",                    "num_sale": 1, "telefono": "0585 811973", "indirizzo": "Via Palestro 37, 54100 Massa MS",                     "lat": 44.0300, "lng": 10.1406},
+    {"nome": "Multisala Odeon",                      "città": "Pisa",                     "num_sale": 4, "telefono": "050 540168",  "indirizzo": "Piazza S. Paolo all'Orto 18, 56127 Pisa PI",          "lat": 43.7188, "lng": 10.4040},
+    {"nome": "Cinema Caffè Lanteri",                 "città": "Pisa",                     "num_sale": 1, "telefono": "050 577100",  "indirizzo": "Via San Michele degli Scalzi 46, 56124 Pisa PI",      "lat": 43.7188, "lng": 10.4180},
+    {"nome": "Cinema Teatro 4 Mori",                 "città": "Livorno",                  "num_sale": 1, "telefono": "342 543 1247","indirizzo": "Via Pietro Tacca 16, 57123 Livorno LI",               "lat": 43.5498, "lng": 10.3122},
+    {"nome": "Multisala Eden",                       "città": "Arezzo",                   "num_sale": 2, "telefono": "0575 353364", "indirizzo": "Via Antonio Guadagnoli 2, 52100 Arezzo AR",            "lat": 43.4632, "lng": 11.8792},
+    {"nome": "Nuovo Cinema Caporali",                "città": "Castiglione del Lago",     "num_sale": 3, "telefono": "075 965 3152","indirizzo": "Piazzetta San Domenico 1, 06061 Castiglione del Lago PG", "lat": 43.1200, "lng": 12.0557},
+    {"nome": "Cinema Teatro Verdi",                  "città": "San Vincenzo",             "num_sale": 1, "telefono": "0565 701918", "indirizzo": "Via Vittorio Emanuele II 121, 57027 San Vincenzo LI",  "lat": 43.0990, "lng": 10.5398},
+    {"nome": "Teatro Signorelli",                    "città": "Cortona",                  "num_sale": 1, "telefono": "0575 601882", "indirizzo": "Piazza Signorelli 13, 52044 Cortona AR",               "lat": 43.2763, "lng": 11.9876},
+    {"nome": "Cinema Città di Villafranca",          "città": "Villafranca in Lunigiana", "num_sale": 1, "telefono": "0187 498011", "indirizzo": "Via Roma 2, 54028 Villafranca in Lunigiana MS",        "lat": 44.3035, "lng":  9.9536},
+    {"nome": "Cinema Teatro Excelsior",              "città": "Reggello",                 "num_sale": 1, "telefono": "055 869190",  "indirizzo": "Via Dante Alighieri 7, 50066 Reggello FI",            "lat": 43.6845, "lng": 11.5340},
+    {"nome": "Cinema Arena Ardenza",                 "città": "Livorno",                  "num_sale": 1, "telefono": "0586 501403", "indirizzo": "Piazza Sforzini 17, 57128 Livorno LI",                "lat": 43.4980, "lng": 10.3350},
+    {"nome": "Arena Dentro Le Mura",                 "città": "San Casciano Val di Pesa", "num_sale": 1, "telefono": "",            "indirizzo": "Via Lucardesi 10, 50026 San Casciano Val di Pesa FI", "lat": 43.6563, "lng": 11.1832},
+]
+
+def _seed_db():
+    """Utente admin e catalogo cinema SigraFilm (solo le righe mancanti)."""
     admin = db.session.execute(db.select(User).filter_by(username="admin")).scalar()
     if not admin:
-        admin = User(username="admin", password_hash=generate_password_hash("admin1234"), password_plain="admin1234", role="admin")
+        admin = User(username="admin", password_hash=hash_password("admin1234"), password_plain="admin1234", role="admin")
         db.session.add(admin)
         db.session.commit()
         print("✅ Utente admin creato automaticamente (username: admin / password: admin1234)")
     # Seed cinema — inserisce solo quelli mancanti (funziona su DB vuoto e già popolato)
-    _cinemas_seed = [
-        {"nome": "Cinema Chiusi",                        "città": "Chiusi",                   "num_sale": 6, "telefono": "0578 275077", "indirizzo": "Loc. Querce al Pino, SP 146, 53043 Chiusi SI",         "lat": 43.0025, "lng": 11.9481},
-        {"nome": "Cinema Empoli",                        "città": "Empoli",                   "num_sale": 3, "telefono": "0571 72023",  "indirizzo": "Via Cosimo Ridolfi 75, 50053 Empoli FI",              "lat": 43.7208, "lng": 10.9478},
-        {"nome": "Cinema Firenze",                       "città": "Firenze",                  "num_sale": 1, "telefono": "055 483607",  "indirizzo": "Via G. Romagnosi 46, 50134 Firenze FI",               "lat": 43.7835, "lng": 11.2427},
-        {"nome": "Cinema Odeon",                         "città": "Firenze",                  "num_sale": 1, "telefono": "055 214068",  "indirizzo": "Piazza degli Strozzi 2, 50123 Firenze FI",            "lat": 43.7711, "lng": 11.2519},
-        {"nome": "Cinema Grosseto",                      "città": "Grosseto",                 "num_sale": 4, "telefono": "0564 27069",  "indirizzo": "Via Goffredo Mameli 24, 58100 Grosseto GR",           "lat": 42.7641, "lng": 11.1086},
-        {"nome": "Cinema Massa",                         "città": "Massa",                    "num_sale": 7, "telefono": "0585 791105", "indirizzo": "Via Dorsale 11, 54100 Massa MS",                      "lat": 44.0181, "lng": 10.1327},
-        {"nome": "Cinema Montecatini",                   "città": "Montecatini Terme",        "num_sale": 4, "telefono": "0572 78510",  "indirizzo": "Piazza Massimo D'Azeglio 5, 51016 Montecatini Terme PT", "lat": 43.8849, "lng": 10.7722},
-        {"nome": "Cinema Pisa",                          "città": "Pisa",                     "num_sale": 3, "telefono": "050 5552261", "indirizzo": "Via Piave 47, 56123 Pisa PI",                         "lat": 43.7155, "lng": 10.3986},
-        {"nome": "Cinecity Pisa",                        "città": "Pisa",                     "num_sale": 5, "telefono": "392 323 3535","indirizzo": "Piazza della Stazione 16, 56125 Pisa PI",             "lat": 43.7090, "lng": 10.3972},
-        {"nome": "Cinema Sansepolcro",                   "città": "Sansepolcro",              "num_sale": 1, "telefono": "0575 733433", "indirizzo": "Via XX Settembre 156, 52037 Sansepolcro AR",           "lat": 43.5695, "lng": 12.1406},
-        {"nome": "ELIA ANTICA MULTISALA",                "città": "Grosseto",                 "num_sale": 4, "telefono": "0564 644987", "indirizzo": "Via Aurelia Antica 46, 58100 Grosseto GR",            "lat": 42.7548, "lng": 11.0931},
-        {"nome": "Cinema Scuderie Granducali Seravezza", "città": "Seravezza",                "num_sale": 1, "telefono": "0584 840409", "indirizzo": "Viale Leonetto Amedei 124, 55047 Seravezza LU",       "lat": 43.9962, "lng": 10.2321},
-        {"nome": "Teatro Cinema Giotto",                 "città": "Borgo San Lorenzo",        "num_sale": 1, "telefono": "055 845 9658","indirizzo": "Corso Giacomo Matteotti 151, 50032 Borgo San Lorenzo FI", "lat": 43.9548, "lng": 11.3855},
-        {"nome": "Cinema Metropolitan",                  "città": "Piombino",                 "num_sale": 1, "telefono": "0565 30385",  "indirizzo": "Piazza Cappelletti 2, 57025 Piombino LI",             "lat": 42.9225, "lng": 10.5320},
-        {"nome": "Cinema Multisala Excelsior",           "città": "Montecatini Terme",        "num_sale": 2, "telefono": "0572 904289", "indirizzo": "Viale Giuseppe Verdi 66, 51016 Montecatini Terme PT", "lat": 43.8825, "lng": 10.7740},
-        {"nome": "Cinema Teatro Scipione Ammirato",      "città": "Montaione",                "num_sale": 1, "telefono": "0571 61517",  "indirizzo": "Piazza Gramsci 2, 50050 Montaione FI",                "lat": 43.5595, "lng": 10.9126},
-        {"nome": "Multisala Isola Verde",                "città": "Pisa",                     "num_sale": 3, "telefono": "050 973676",  "indirizzo": "Via Vittorio Frascani, 56124 Pisa PI",                "lat": 43.7024, "lng": 10.3912},
-        {"nome": "Cinema Sala Esse",                     "città": "Firenze",                  "num_sale": 1, "telefono": "055 666643",  "indirizzo": "Via del Ghirlandaio 38, 50121 Firenze FI",            "lat": 43.7697, "lng": 11.2763},
-        {"nome": "Multisala Goldoni",                    "città": "Viareggio",                "num_sale": 2, "telefono": "0584 49832",  "indirizzo": "Via San Francesco 124, 55049 Viareggio LU",           "lat": 43.8682, "lng": 10.2547},
-        {"nome": "Cinema Multisala Il Portico",          "città": "Firenze",                  "num_sale": 2, "telefono": "055 669930",  "indirizzo": "Via Capo di Mondo 66, 50136 Firenze FI",              "lat": 43.7698, "lng": 11.2919},
-        {"nome": "Cinema Teatro Everest Galluzzo",       "città": "Firenze",                  "num_sale": 1, "telefono": "055 232 1754","indirizzo": "Via Volterrana 4, 50124 Firenze FI",                  "lat": 43.7388, "lng": 11.2413},
-        {"nome": "Spazio Alfieri Cinema Teatro Bistrò",  "città": "Firenze",                  "num_sale": 1, "telefono": "055 5320840", "indirizzo": "Via dell'Ulivo 8, 50122 Firenze FI",                  "lat": 43.7703, "lng": 11.2639},
-        {"nome": "Cinema Teatro Multisala Imperiale",    "città": "Montecatini Terme",        "num_sale": 4, "telefono": "0572 508601", "indirizzo": "Piazza Massimo D'Azeglio 5, 51016 Montecatini Terme PT", "lat": 43.8849, "lng": 10.7722},
-        {"nome": "Cinema Centrale",                      "città": "Viareggio",                "num_sale": 1, "telefono": "0584 581226", "indirizzo": "Via Cesare Battisti 67, 55049 Viareggio LU",          "lat": 43.8707, "lng": 10.2534},
-        {"nome": "Cinema Nuova Aurora",                  "città": "Sansepolcro",              "num_sale": 1, "telefono": "0575 1480629","indirizzo": "Via Piero della Francesca 47, 52037 Sansepolcro AR",  "lat": 43.5696, "lng": 12.1393},
-        {"nome": "Cinema Marconi",                       "città": "Firenze",                  "num_sale": 3, "telefono": "055 680554",  "indirizzo": "Viale Giannotti 45r, 50126 Firenze FI",               "lat": 43.7526, "lng": 11.2694},
-        {"nome": "Multisala Splendor",                   "città": "Massa",                    "num_sale": 7, "telefono": "0585 791105", "indirizzo": "Via Dorsale 11, 54100 Massa MS",                      "lat": 44.0181, "lng": 10.1327},
-        {"nome": "Teatro dei Servi",                     "città": "Massa",                    "num_sale": 1, "telefono": "0585 811973", "indirizzo": "Via Palestro 37, 54100 Massa MS",                     "lat": 44.0300, "lng": 10.1406},
-        {"nome": "Multisala Odeon",                      "città": "Pisa",                     "num_sale": 4, "telefono": "050 540168",  "indirizzo": "Piazza S. Paolo all'Orto 18, 56127 Pisa PI",          "lat": 43.7188, "lng": 10.4040},
-        {"nome": "Cinema Caffè Lanteri",                 "città": "Pisa",                     "num_sale": 1, "telefono": "050 577100",  "indirizzo": "Via San Michele degli Scalzi 46, 56124 Pisa PI",      "lat": 43.7188, "lng": 10.4180},
-        {"nome": "Cinema Teatro 4 Mori",                 "città": "Livorno",                  "num_sale": 1, "telefono": "342 543 1247","indirizzo": "Via Pietro Tacca 16, 57123 Livorno LI",               "lat": 43.5498, "lng": 10.3122},
-        {"nome": "Multisala Eden",                       "città": "Arezzo",                   "num_sale": 2, "telefono": "0575 353364", "indirizzo": "Via Antonio Guadagnoli 2, 52100 Arezzo AR",            "lat": 43.4632, "lng": 11.8792},
-        {"nome": "Nuovo Cinema Caporali",                "città": "Castiglione del Lago",     "num_sale": 3, "telefono": "075 965 3152","indirizzo": "Piazzetta San Domenico 1, 06061 Castiglione del Lago PG", "lat": 43.1200, "lng": 12.0557},
-        {"nome": "Cinema Teatro Verdi",                  "città": "San Vincenzo",             "num_sale": 1, "telefono": "0565 701918", "indirizzo": "Via Vittorio Emanuele II 121, 57027 San Vincenzo LI",  "lat": 43.0990, "lng": 10.5398},
-        {"nome": "Teatro Signorelli",                    "città": "Cortona",                  "num_sale": 1, "telefono": "0575 601882", "indirizzo": "Piazza Signorelli 13, 52044 Cortona AR",               "lat": 43.2763, "lng": 11.9876},
-        {"nome": "Cinema Città di Villafranca",          "città": "Villafranca in Lunigiana", "num_sale": 1, "telefono": "0187 498011", "indirizzo": "Via Roma 2, 54028 Villafranca in Lunigiana MS",        "lat": 44.3035, "lng":  9.9536},
-        {"nome": "Cinema Teatro Excelsior",              "città": "Reggello",                 "num_sale": 1, "telefono": "055 869190",  "indirizzo": "Via Dante Alighieri 7, 50066 Reggello FI",            "lat": 43.6845, "lng": 11.5340},
-        {"nome": "Cinema Arena Ardenza",                 "città": "Livorno",                  "num_sale": 1, "telefono": "0586 501403", "indirizzo": "Piazza Sforzini 17, 57128 Livorno LI",                "lat": 43.4980, "lng": 10.3350},
-        {"nome": "Arena Dentro Le Mura",                 "città": "San Casciano Val di Pesa", "num_sale": 1, "telefono": "",            "indirizzo": "Via Lucardesi 10, 50026 San Casciano Val di Pesa FI", "lat": 43.6563, "lng": 11.1832},
-    ]
-    _existing_nomi = {c.nome for c in Cinema.query.all()}
-    _deleted_nomi  = {d.nome for d in DeletedCinema.query.all()}
-    _added = 0
-    for c in _cinemas_seed:
-        if c["nome"] not in _existing_nomi and c["nome"] not in _deleted_nomi:
-            db.session.add(Cinema(**c))
-            _added += 1
-    # Aggiorna contatti per cinema già esistenti che non li hanno
-    _updated = 0
-    _cinema_map = {c.nome: c for c in Cinema.query.all()}
-    for s in _cinemas_seed:
-        existing = _cinema_map.get(s["nome"])
-        if existing and not existing.indirizzo:
+    cinema_map = {c.nome: c for c in Cinema.query.all()}
+    deleted_nomi = {nome for (nome,) in db.session.query(DeletedCinema.nome)}
+    added = 0
+    updated = 0
+    for s in CINEMAS_SEED:
+        existing = cinema_map.get(s["nome"])
+        if existing is None:
+            if s["nome"] not in deleted_nomi:
+                c = Cinema(**s)
+                db.session.add(c)
+                cinema_map[c.nome] = c
+                added += 1
+        elif not existing.indirizzo:
+            # Aggiorna contatti per cinema già esistenti che non li hanno
             existing.indirizzo = s.get("indirizzo", "")
             existing.telefono  = s.get("telefono", "")
             existing.lat       = s.get("lat")
             existing.lng       = s.get("lng")
-            _updated += 1
-    if _added or _updated:
-        db.session.commit()
-        if _added:   print(f"✅ {_added} cinema aggiunti al catalogo")
-        if _updated: print(f"✅ {_updated} cinema aggiornati con contatti")
-    # Migra cinema dai problemi esistenti non ancora in tabella
-    existing_nomi = {c.nome for c in Cinema.query.all()}  # ricarica dopo seed
-    for p in Problem.query.all():
-        if p.cinema and p.cinema.strip() and p.cinema.strip() not in existing_nomi:
-            db.session.add(Cinema(nome=p.cinema.strip(), città="", num_sale=1))
-            existing_nomi.add(p.cinema.strip())
+            updated += 1
+    # I cinema citati solo dai ticket li crea la migrazione 12 (o `flask backfill-cinemas`):
+    # qui niente letture su problems oltre ai ticket non collegati, via indice cinema_id
+    if added:
+        db.session.flush()
+        _link_problems_to_cinemas(db.session.connection())
+    if added or updated:
+        _bump_cinema_catalog()
     db.session.commit()
+    if added:      print(f"✅ {added} cinema aggiunti al catalogo")
+    if updated:    print(f"✅ {updated} cinema aggiornati con contatti")
+
+@app.cli.command("db-upgrade")
+def db_upgrade_command():
+    """Crea/aggiorna lo schema del database (una volta per deploy)."""
+    applied = _upgrade_db()
+    if not applied:
+        print("Schema già aggiornato.")
+
+@app.cli.command("seed")
+def seed_command():
+    """Inserisce admin e catalogo cinema mancanti (idempotente)."""
+    _seed_db()
+
+@app.cli.command("backfill-cinemas")
+def backfill_cinemas_command():
+    """Crea i cinema citati dai ticket ma non in catalogo (legge tutta la tabella problems)."""
+    with db.engine.begin() as conn:
+        backfilled = _backfill_cinemas_from_problems(conn)
+    print(f"✅ {backfilled} cinema recuperati dai ticket" if backfilled else "Nessun cinema da recuperare.")
+
+# --- CATALOGO CINEMA (cache in processo) ---
+# La tabella cinemas è piccola e quasi statica: ogni worker ne tiene una copia
+# (tuple immutabili, non oggetti ORM legati a una sessione). Le modifiche
+# incrementano catalog_versions nella stessa transazione; gli altri worker
+# confrontano la versione al massimo ogni CINEMA_CACHE_TTL secondi.
+app.config["CINEMA_CACHE_TTL"] = float(os.environ.get("CINEMA_CACHE_TTL", "5"))
+
+CinemaInfo = namedtuple("CinemaInfo", "id nome città num_sale telefono indirizzo lat lng")
+
+# --- INDICE SPAZIALE CINEMA ---
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Distanza sul globo in km tra due punti in gradi."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+class CinemaGrid:
+    """Griglia a celle di cell_deg gradi sui cinema con coordinate.
+
+    Una query a raggio visita solo le celle del riquadro che contiene il cerchio e
+    filtra con la distanza haversine esatta; i k più vicini si ottengono allargando
+    il raggio finché bastano. Si ricostruisce insieme al catalogo cinema.
+    """
+
+    def __init__(self, cinemas, cell_deg=0.25):
+        self.cell_deg = cell_deg
+        self.cells = {}
+        self.size = 0
+        for c in cinemas:
+            if c.lat is None or c.lng is None:
+                continue
+            self.cells.setdefault(self._cell(c.lat, c.lng), []).append(c)
+            self.size += 1
+
+    def _cell(self, lat, lng):
+        return math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg)
+
+    def _candidates(self, lat, lng, radius_km):
+        dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        cos_lat = math.cos(math.radians(min(90.0, abs(lat) + dlat)))
+        dlng = math.degrees(radius_km / (EARTH_RADIUS_KM * cos_lat)) if cos_lat > 1e-9 else 360.0
+        (i0, j0), (i1, j1) = self._cell(lat - dlat, lng - dlng), self._cell(lat + dlat, lng + dlng)
+        if lng - dlng < -180 or lng + dlng > 180 or (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.cells):
+            # riquadro a cavallo dell'antimeridiano o più grande della griglia: tutte le celle
+            for bucket in self.cells.values():
+                yield from bucket
+            return
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                yield from self.cells.get((i, j), ())
+
+    def within(self, lat, lng, radius_km, where=None):
+        """[(distanza_km, CinemaInfo)] entro radius_km, dal più vicino."""
+        found = []
+        for c in self._candidates(lat, lng, radius_km):
+            if where is not None and not where(c):
+                continue
+            d = haversine_km(lat, lng, c.lat, c.lng)
+            if d <= radius_km:
+                found.append((d, c))
+        found.sort(key=lambda x: x[0])
+        return found
+
+    def nearest(self, lat, lng, k, where=None, max_km=None):
+        """I k cinema più vicini (eventualmente entro max_km) come [(distanza_km, CinemaInfo)]."""
+        limit = max_km if max_km is not None else math.pi * EARTH_RADIUS_KM
+        radius = min(limit, self.cell_deg * 111.2)
+        while True:
+            found = self.within(lat, lng, radius, where)
+            if len(found) >= k or radius >= limit:
+                return found[:k]
+            radius = min(limit, radius * 2)
+
+_cinema_catalog = {"version": None, "checked_at": 0.0}
+_cinema_catalog_lock = threading.Lock()
+
+def _load_cinema_catalog(version):
+    rows = db.session.execute(
+        db.select(Cinema.id, Cinema.nome, Cinema.città, Cinema.num_sale, Cinema.telefono,
+                  Cinema.indirizzo, Cinema.lat, Cinema.lng)
+    ).all()
+    cinemas = [CinemaInfo(*r) for r in rows]
+    by_nome = sorted(cinemas, key=lambda c: c.nome)
+    return {
+        "version": version,
+        "checked_at": time.monotonic(),
+        "by_id": {c.id: c for c in cinemas},
+        "by_name": {c.nome: c for c in cinemas},
+        "by_nome": by_nome,                                              # dashboard, edit_problem
+        "by_città": sorted(cinemas, key=lambda c: (c.città, c.nome)),   # admin, user_detail
+        # struttura città → cinema → sale per il form della dashboard
+        "js": [{"id": c.id, "nome": c.nome, "città": c.città, "numSale": c.num_sale} for c in by_nome],
+        "geo": CinemaGrid(cinemas),                                      # vicinanza / raggio
+    }
+
+def cinema_catalog():
+    """Catalogo cinema corrente: ricaricato solo se la versione condivisa è cambiata."""
+    global _cinema_catalog
+    catalog = _cinema_catalog
+    if catalog["version"] is not None and \
+            time.monotonic() - catalog["checked_at"] < app.config["CINEMA_CACHE_TTL"]:
+        return catalog
+    with _cinema_catalog_lock:
+        version = db.session.execute(
+            db.select(CatalogVersion.version).where(CatalogVersion.name == "cinemas")
+        ).scalar() or 0
+        if version != _cinema_catalog["version"]:
+            _cinema_catalog = _load_cinema_catalog(version)
+        else:
+            _cinema_catalog["checked_at"] = time.monotonic()
+        return _cinema_catalog
+
+def _bump_cinema_catalog():
+    """Invalida il catalogo in tutti i worker. Va chiamata prima del commit della modifica."""
+    db.session.execute(
+        db.update(CatalogVersion).where(CatalogVersion.name == "cinemas")
+        .values(version=CatalogVersion.version + 1)
+    )
+    db.session.info["cinema_catalog_bumped"] = True
+
+@event.listens_for(db.session, "after_commit")
+def _cinema_catalog_after_commit(sess):
+    # Questo worker ricontrolla subito, ma solo a commit avvenuto: azzerando prima, un altro
+    # thread potrebbe rileggere la versione vecchia e tenersi il catalogo per CINEMA_CACHE_TTL
+    if sess.info.pop("cinema_catalog_bumped", False):
+        _cinema_catalog["checked_at"] = 0.0
+
+@event.listens_for(db.session, "after_rollback")
+def _cinema_catalog_after_rollback(sess):
+    sess.info.pop("cinema_catalog_bumped", None)
 
 # --- ROUTES ---
 @app.route("/")
@@ -214,21 +675,144 @@ def index():
         return redirect(url_for("dashboard"))
     return redirect(url_for("login"))
 
+# --- PASSWORD ---
+# Verificare una password (scrypt/pbkdf2) costa ~100 ms di CPU. Per non togliere CPU alle
+# dashboard durante i picchi di login (cambio turno) la verifica gira in un pool limitato:
+# PASSWORD_HASH_WORKERS thread per processo (hashlib rilascia il GIL, quindi lavorano davvero
+# in parallelo) e al massimo PASSWORD_HASH_QUEUE verifiche in attesa; oltre, il login risponde
+# 503 senza calcolare nulla. Ogni login in verifica o in coda occupa anche un thread gunicorn,
+# quindi di default verifiche + coda restano sotto GUNICORN_THREADS: almeno un thread per
+# processo è sempre libero per le altre richieste. I tentativi falliti sono limitati per
+# username e per IP (in memoria, per processo) e vengono respinti prima di arrivare all'hash.
+_request_threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+_password_slots_default = max(1, _request_threads - 1)
+app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get(
+    "PASSWORD_HASH_WORKERS", min(2, _password_slots_default)))
+app.config["PASSWORD_HASH_QUEUE"] = int(os.environ.get(
+    "PASSWORD_HASH_QUEUE", max(0, _password_slots_default - app.config["PASSWORD_HASH_WORKERS"])))
+app.config["LOGIN_MAX_ATTEMPTS"] = int(os.environ.get("LOGIN_MAX_ATTEMPTS", "5"))
+app.config["LOGIN_MAX_ATTEMPTS_IP"] = int(os.environ.get("LOGIN_MAX_ATTEMPTS_IP", "30"))
+app.config["LOGIN_WINDOW_SECONDS"] = int(os.environ.get("LOGIN_WINDOW_SECONDS", "900"))
+app.config["LOGIN_MAX_TRACKED"] = int(os.environ.get("LOGIN_MAX_TRACKED", "10000"))
+
+_password_executor = None
+_password_slots = None  # semaforo: verifiche in corso + in coda
+_password_lock = threading.Lock()
+# ("user", username) / ("ip", indirizzo) -> deque dei tentativi falliti, in ordine di ultimo
+# fallimento: al più LOGIN_MAX_TRACKED chiavi, anche sotto uno spray di username casuali
+_login_failures = OrderedDict()
+_login_failures_lock = threading.Lock()
+
+def hash_password(password):
+    return generate_password_hash(password, method=app.config["PASSWORD_HASH_METHOD"])
+
+@functools.lru_cache(maxsize=None)
+def _password_hash_prefix(method):
+    """Metodo e parametri con cui hash_password calcola oggi gli hash, es. "scrypt:32768:8:1"."""
+    return generate_password_hash("", method=method).split("$", 1)[0]
+
+def _verify_password(stored_hash, password):
+    """(password corretta, nuovo hash se quello salvato usa metodo o parametri superati)."""
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    if stored_hash.split("$", 1)[0] != _password_hash_prefix(app.config["PASSWORD_HASH_METHOD"]):
+        return True, hash_password(password)
+    return True, None
+
+def _run_password_job(fn, *args):
+    """Esegue fn nel pool delle password e ne attende il risultato; None se il pool è saturo."""
+    global _password_executor, _password_slots
+    workers = app.config["PASSWORD_HASH_WORKERS"]
+    if workers <= 0:
+        return fn(*args)  # 0 = nel thread della richiesta, come prima
+    with _password_lock:
+        if _password_executor is None:
+            _password_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password")
+            _password_slots = threading.BoundedSemaphore(workers + app.config["PASSWORD_HASH_QUEUE"])
+    if not _password_slots.acquire(blocking=False):
+        return None
+    try:
+        return _password_executor.submit(fn, *args).result()
+    finally:
+        _password_slots.release()
+
+def _login_keys(username, ip):
+    return ((("user", username), app.config["LOGIN_MAX_ATTEMPTS"]),
+            (("ip", ip), app.config["LOGIN_MAX_ATTEMPTS_IP"]))
+
+def _login_retry_after(username, ip):
+    """Secondi di attesa se username o IP hanno esaurito i tentativi nella finestra, altrimenti 0."""
+    window = app.config["LOGIN_WINDOW_SECONDS"]
+    now = time.monotonic()
+    wait = 0.0
+    with _login_failures_lock:
+        for key, limit in _login_keys(username, ip):
+            hits = _login_failures.get(key)
+            while hits and hits[0] <= now - window:
+                hits.popleft()
+            if hits is not None and not hits:
+                del _login_failures[key]
+            elif limit > 0 and hits and len(hits) >= limit:
+                wait = max(wait, hits[0] + window - now)
+    return math.ceil(wait)
+
+def _login_failed(username, ip):
+    now = time.monotonic()
+    cutoff = now - app.config["LOGIN_WINDOW_SECONDS"]
+    with _login_failures_lock:
+        for key, _ in _login_keys(username, ip):
+            hits = _login_failures.get(key)
+            if hits is None:
+                hits = _login_failures[key] = deque()
+            else:
+                _login_failures.move_to_end(key)
+            hits.append(now)
+        # In testa le chiavi ferme da più tempo: prima quelle scadute, poi oltre il limite
+        while _login_failures:
+            oldest = next(iter(_login_failures.values()))
+            if oldest[-1] > cutoff and len(_login_failures) <= app.config["LOGIN_MAX_TRACKED"]:
+                break
+            _login_failures.popitem(last=False)
+
+def _login_succeeded(username):
+    with _login_failures_lock:
+        _login_failures.pop(("user", username), None)
+
 # --- LOGIN ---
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         username = request.form["username"].strip()
         password = request.form["password"]
+        ip = request.remote_addr or ""
+
+        wait = _login_retry_after(username, ip)
+        if wait:
+            flash(f"Troppi tentativi falliti: riprova tra {math.ceil(wait / 60)} minuti.", "danger")
+            return render_template("login.html"), 429, {"Retry-After": str(wait)}
 
         u = db.session.execute(db.select(User).filter_by(username=username)).scalar()
-        if u and check_password_hash(u.password_hash, password):
+        db.session.close()  # nessuna connessione DB occupata mentre si aspetta l'hash
+        ok = False
+        if u:
+            result = _run_password_job(_verify_password, u.password_hash, password)
+            if result is None:
+                flash("Troppi accessi in corso, riprova tra qualche secondo.", "warning")
+                return render_template("login.html"), 503, {"Retry-After": "2"}
+            ok, new_hash = result
+        if ok:
+            if new_hash:  # hash con parametri vecchi: aggiornato ora che si conosce la password
+                db.session.execute(db.update(User).where(User.id == u.id).values(password_hash=new_hash))
+                db.session.commit()
+            _login_succeeded(username)
             session["user_id"] = u.id
             session["role"] = u.role
             session["username"] = u.username
             flash("Login effettuato", "success")
             return redirect(url_for("dashboard"))
 
+        _login_failed(username, ip)
         flash("Credenziali non valide", "danger")
     return render_template("login.html")
 
@@ -237,13 +821,13 @@ def login():
 def reset_admin_password():
     admin = db.session.execute(db.select(User).filter_by(username="admin")).scalar()
     if admin:
-        admin.password_hash = generate_password_hash("admin1234")
+        admin.password_hash = hash_password("admin1234")
         admin.password_plain = "admin1234"
         admin.role = "admin"
         db.session.commit()
         return "Password admin resettata a 'admin1234'."
     else:
-        admin = User(username="admin", password_hash=generate_password_hash("admin1234"), password_plain="admin1234", role="admin")
+        admin = User(username="admin", password_hash=hash_password("admin1234"), password_plain="admin1234", role="admin")
         db.session.add(admin)
         db.session.commit()
         return "Utente admin ricreato con password 'admin1234'."
@@ -255,14 +839,100 @@ def logout():
     flash("Logout effettuato", "info")
     return redirect(url_for("login"))
 
-# --- DASHBOARD ---
-@app.route("/dashboard")
-def dashboard():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
+# --- CONTATORI CHAT ---
+def _chat_counts(user_id, problems):
+    """Messaggi totali e non letti per ticket con una sola query aggregata.
+
+    Il totale arriva da Problem.comment_count; i non letti si contano in SQL
+    (join con TicketRead dell'utente) solo per i ticket che hanno messaggi.
+    """
+    chat_info = {p.id: {"total": p.comment_count or 0, "unread": 0} for p in problems}
+    ids = [p.id for p in problems if p.comment_count]
+    if not ids:
+        return chat_info
+    rows = db.session.execute(
+        db.select(Comment.problem_id, db.func.count(Comment.id))
+        .outerjoin(TicketRead, db.and_(TicketRead.problem_id == Comment.problem_id,
+                                       TicketRead.user_id == user_id))
+        .where(Comment.problem_id.in_(ids))
+        .where(db.or_(TicketRead.last_read_at.is_(None), Comment.data_ora > TicketRead.last_read_at))
+        .group_by(Comment.problem_id)
+    ).all()
+    for problem_id, unread in rows:
+        chat_info[problem_id]["unread"] = unread
+    return chat_info
+
+# --- PAGINAZIONE KEYSET (data_ora, id) ---
+def _encode_cursor(p):
+    return f"{p.data_ora.strftime('%Y%m%d%H%M%S%f')}-{p.id}"
+
+def _decode_cursor(value):
+    try:
+        ts, pid = value.split("-", 1)
+        return datetime.strptime(ts, "%Y%m%d%H%M%S%f"), int(pid)
+    except (AttributeError, ValueError):
+        return None
+
+def _page_size():
+    try:
+        n = int(request.args.get("per_page", app.config["PAGE_SIZE"]))
+    except ValueError:
+        n = app.config["PAGE_SIZE"]
+    return max(1, min(n, 200))
+
+def _keyset_page(query):
+    """Pagina di ticket ordinati per (data_ora, id) decrescenti.
+
+    Usa i cursori ?after= / ?before= della richiesta: ogni pagina costa
+    LIMIT per_page+1 righe indipendentemente dalla dimensione dell'archivio,
+    ed è stabile anche se nel frattempo vengono inseriti nuovi ticket.
+    Restituisce (problems, next_cursor, prev_cursor).
+    """
+    per_page = _page_size()
+    after = _decode_cursor(request.args.get("after"))
+    before = _decode_cursor(request.args.get("before")) if not after else None
+
+    if before:
+        dt, pid = before
+        rows = (query.filter(db.or_(Problem.data_ora > dt,
+                                    db.and_(Problem.data_ora == dt, Problem.id > pid)))
+                .order_by(Problem.data_ora.asc(), Problem.id.asc())
+                .limit(per_page + 1).all())
+        has_prev = len(rows) > per_page
+        problems = list(reversed(rows[:per_page]))
+        has_next = True
+    else:
+        if after:
+            dt, pid = after
+            query = query.filter(db.or_(Problem.data_ora < dt,
+                                        db.and_(Problem.data_ora == dt, Problem.id < pid)))
+        rows = (query.order_by(Problem.data_ora.desc(), Problem.id.desc())
+                .limit(per_page + 1).all())
+        has_next = len(rows) > per_page
+        problems = rows[:per_page]
+        has_prev = after is not None
+
+    next_cursor = _encode_cursor(problems[-1]) if problems and has_next else None
+    prev_cursor = _encode_cursor(problems[0]) if problems and has_prev else None
+    return problems, next_cursor, prev_cursor
 
+# --- DASHBOARD ---
+def _visible_cinema_ids(uid):
+    """Cinema assegnati all'utente; None se li vede tutti (admin o nessuna assegnazione)."""
+    if session.get("role") == "admin":
+        return None
+    ids = {cid for (cid,) in db.session.query(UserCinema.cinema_id).filter_by(user_id=uid)}
+    return ids or None
+
+def _dashboard_tickets():
+    """Ticket aperti (pagina corrente), stats e contatori chat per la sessione corrente.
+
+    Stessi filtri e scope per ruolo usati da /dashboard e /api/dashboard.
+    """
     filter_urgenza = request.args.get("filter_urgenza", "")
     filter_stato = request.args.get("filter_stato", "")
+    filter_near = request.args.get("near", type=int)
+    filter_radius = min(max(request.args.get("radius_km", type=float) or 40.0, 0.0), 2000.0)
 
     query = Problem.query.filter(Problem.stato != "Chiuso")
     if session["role"] != "admin":
@@ -271,58 +941,317 @@ def dashboard():
         query = query.filter_by(urgenza=filter_urgenza)
     if filter_stato:
         query = query.filter_by(stato=filter_stato)
+    if filter_near:
+        # Ticket dei cinema entro il raggio dal cinema scelto (lui compreso)
+        catalog = cinema_catalog()
+        origin = catalog["by_id"].get(filter_near)
+        near_ids = [origin.id] if origin else []
+        if origin and origin.lat is not None and origin.lng is not None:
+            near_ids = [c.id for _, c in catalog["geo"].within(origin.lat, origin.lng, filter_radius)]
+        query = query.filter(Problem.cinema_id.in_(near_ids))
+
+    problems, next_cursor, prev_cursor = _keyset_page(query)
+
+    # Stats sulla lista non filtrata (scope utente, escluso chiusi): un solo GROUP BY
+    stats_q = (db.select(Problem.stato, Problem.urgenza, db.func.count(Problem.id))
+               .where(Problem.stato != "Chiuso")
+               .group_by(Problem.stato, Problem.urgenza))
+    if session["role"] != "admin":
+        stats_q = stats_q.where(Problem.autore == session["username"])
+    stats = {"total": 0, "aperto": 0, "in_corso": 0, "chiuso": 0, "critico": 0}
+    for stato, urgenza, n in db.session.execute(stats_q):
+        stats["total"] += n
+        if stato == "Aperto":
+            stats["aperto"] += n
+        elif stato == "In corso":
+            stats["in_corso"] += n
+        if urgenza == "Critico":
+            stats["critico"] += n
+
+    return {
+        "problems": problems,
+        "filter_urgenza": filter_urgenza,
+        "filter_stato": filter_stato,
+        "filter_near": filter_near,
+        "filter_radius": filter_radius,
+        "stats": stats,
+        "chat_info": _chat_counts(session["user_id"], problems),
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+    }
 
-    problems = query.order_by(Problem.data_ora.desc()).all()
+def _dashboard_etag():
+    """Versione dei dati della dashboard per l'utente: una query aggregata economica.
 
-    # Stats e cinemas dalla lista non filtrata (scope utente, escluso chiusi)
-    base_query = Problem.query.filter(Problem.stato != "Chiuso")
+    Cambia se cambia un ticket aperto nel suo scope (updated_at si aggiorna anche
+    con nuovi messaggi), se un ticket entra/esce dallo scope (count, max id), se
+    l'utente legge un ticket (non letti) o se cambiano filtri/pagina.
+    """
+    q = (db.select(db.func.count(Problem.id), db.func.max(Problem.id), db.func.max(Problem.updated_at))
+         .where(Problem.stato != "Chiuso"))
     if session["role"] != "admin":
-        base_query = base_query.filter_by(autore=session["username"])
-    all_problems = base_query.all()
-
-    stats = {
-        "total":    len(all_problems),
-        "aperto":   sum(1 for p in all_problems if p.stato == "Aperto"),
-        "in_corso": sum(1 for p in all_problems if p.stato == "In corso"),
-        "chiuso":   0,
-        "critico":  sum(1 for p in all_problems if p.urgenza == "Critico"),
-    }
-    uid = session["user_id"]
-    if session["role"] == "admin":
-        cinemas = Cinema.query.order_by(Cinema.nome.asc()).all()
-    else:
-        assigned = UserCinema.query.filter_by(user_id=uid).all()
-        if assigned:
-            cinema_ids = [a.cinema_id for a in assigned]
-            cinemas = Cinema.query.filter(Cinema.id.in_(cinema_ids)).order_by(Cinema.nome.asc()).all()
-        else:
-            cinemas = Cinema.query.order_by(Cinema.nome.asc()).all()
-    single_cinema = cinemas[0] if len(cinemas) == 1 else None
+        q = q.where(Problem.autore == session["username"])
+    version = db.session.execute(q).one()
+    last_read = db.session.execute(
+        db.select(db.func.max(TicketRead.last_read_at)).where(TicketRead.user_id == session["user_id"])
+    ).scalar()
+    args = sorted((k, v) for k, v in request.args.items()
+                  if k in ("filter_urgenza", "filter_stato", "near", "radius_km", "after", "before", "per_page"))
+    catalog_version = cinema_catalog()["version"] if request.args.get("near") else None
+    raw = f"{session['user_id']}|{session['role']}|{tuple(version)}|{last_read}|{args}|{catalog_version}"
+    return hashlib.sha1(raw.encode()).hexdigest()
 
-    # Contatori messaggi e non letti per ogni ticket
-    reads = {tr.problem_id: tr.last_read_at
-             for tr in TicketRead.query.filter_by(user_id=uid).all()}
-    chat_info = {}
-    for p in problems:
-        total = len(p.comments)
-        last_read = reads.get(p.id)
-        if last_read is None:
-            unread = total
-        else:
-            unread = sum(1 for c in p.comments if c.data_ora > last_read)
-        chat_info[p.id] = {"total": total, "unread": unread}
+@app.route("/dashboard")
+def dashboard():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    _flush_user_read_receipts(session["user_id"])  # badge "non letto" aggiornati per le sue letture
+    data = _dashboard_tickets()
+    catalog = cinema_catalog()
+    cinemas, cinemas_js = catalog["by_nome"], catalog["js"]
+    cinema_ids = _visible_cinema_ids(session["user_id"])
+    if cinema_ids:
+        cinemas = [c for c in cinemas if c.id in cinema_ids]
+        cinemas_js = [c for c in cinemas_js if c["id"] in cinema_ids]
+    single_cinema = cinemas[0] if len(cinemas) == 1 else None
 
     return render_template(
         "dashboard.html",
-        problems=problems,
-        filter_urgenza=filter_urgenza,
-        filter_stato=filter_stato,
-        stats=stats,
         cinemas=cinemas,
-        chat_info=chat_info,
+        cinemas_js=cinemas_js,
         single_cinema=single_cinema,
+        etag=_dashboard_etag(),
+        **data,
     )
 
+@app.route("/api/dashboard")
+def api_dashboard():
+    """Dati della dashboard in JSON; risponde 304 se l'ETag del client è ancora valido."""
+    if "user_id" not in session:
+        return {"error": "login richiesto"}, 401
+    _flush_user_read_receipts(session["user_id"])
+    def build():
+        data = _dashboard_tickets()
+        admin = session.get("role") == "admin"
+        def row(p):
+            # La pagina ridisegna le righe da qui: stessi link e permessi del template
+            can_edit = admin or session.get("username") == p.autore
+            return {
+                "id": p.id, "cinema": p.cinema, "città": p.città, "sala": p.sala, "tipo": p.tipo,
+                "urgenza": p.urgenza, "stato": p.stato, "autore": p.autore,
+                "data_ora": p.data_ora.isoformat() if p.data_ora else None,
+                "chat": data["chat_info"][p.id],
+                "url": url_for("ticket_detail", problem_id=p.id),
+                "edit_url": url_for("edit_problem", problem_id=p.id) if can_edit else None,
+                "delete_url": url_for("delete_problem", problem_id=p.id) if can_edit else None,
+            }
+        return {
+            "problems": [row(p) for p in data["problems"]],
+            "stats": data["stats"],
+            "next_cursor": data["next_cursor"],
+            "prev_cursor": data["prev_cursor"],
+        }
+    return _conditional_json(_dashboard_etag(), build)
+
+def _conditional_json(etag, build, mimetype=None):
+    """Risposta JSON con ETag: 304 senza chiamare build() se il client ha già questa versione."""
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = app.json.response(build())
+        if mimetype:
+            resp.mimetype = mimetype
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+# --- CONFERME DI LETTURA ---
+# Aprire un ticket scrive solo se ci sono messaggi più recenti dell'ultima lettura, con
+# un solo upsert. Con READ_RECEIPT_FLUSH_SECONDS > 0 le conferme restano in memoria nel
+# worker e vengono scritte a blocchi (al più ogni N secondi, o quando l'utente torna in
+# dashboard): meno scritture, al prezzo di badge "non letto" in ritardo di qualche
+# secondo se la richiesta successiva arriva a un altro worker.
+app.config["READ_RECEIPT_FLUSH_SECONDS"] = float(os.environ.get("READ_RECEIPT_FLUSH_SECONDS", "0"))
+
+_read_receipts = {}  # (user_id, problem_id) -> last_read_at ancora da scrivere
+_read_receipts_lock = threading.Lock()
+_read_receipts_timer = None
+
+def _upsert_read_receipts(rows):
+    """INSERT ... ON CONFLICT DO UPDATE (anche executemany) che non arretra mai last_read_at."""
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    t = TicketRead.__table__
+    stmt = dialect.insert(t)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[t.c.user_id, t.c.problem_id],
+        set_={"last_read_at": stmt.excluded.last_read_at},
+        where=db.or_(t.c.last_read_at.is_(None), t.c.last_read_at < stmt.excluded.last_read_at),
+    )
+    db.session.execute(stmt, rows)
+
+def _mark_read(p):
+    """Segna il ticket come letto dall'utente corrente, se c'è qualcosa di nuovo da leggere."""
+    if p.last_comment_at is None:
+        return  # nessun messaggio: niente "non letti" da azzerare
+    key = (session["user_id"], p.id)
+    now = datetime.utcnow()
+    if app.config["READ_RECEIPT_FLUSH_SECONDS"] > 0:
+        with _read_receipts_lock:
+            pending = _read_receipts.get(key)
+            if pending is not None and pending >= p.last_comment_at:
+                return
+            _read_receipts[key] = now
+        _schedule_read_receipt_flush()
+        return
+    last_read = db.session.execute(
+        db.select(TicketRead.last_read_at)
+        .where(TicketRead.user_id == key[0], TicketRead.problem_id == key[1])
+    ).scalar()
+    if last_read is not None and last_read >= p.last_comment_at:
+        return
+    _upsert_read_receipts([{"user_id": key[0], "problem_id": key[1], "last_read_at": now}])
+    db.session.commit()
+
+def _flush_read_receipts(user_id=None):
+    """Scrive in un solo batch le conferme in attesa (tutte o solo quelle di user_id)."""
+    with _read_receipts_lock:
+        keys = [k for k in _read_receipts if user_id is None or k[0] == user_id]
+        batch = [{"user_id": u, "problem_id": pid, "last_read_at": _read_receipts.pop((u, pid))}
+                 for u, pid in keys]
+    if not batch:
+        return
+    try:
+        _upsert_read_receipts(batch)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        with _read_receipts_lock:  # riprova al prossimo flush, senza scavalcare letture più recenti
+            for r in batch:
+                key = (r["user_id"], r["problem_id"])
+                _read_receipts[key] = max(r["last_read_at"], _read_receipts.get(key, r["last_read_at"]))
+        raise
+
+def _flush_user_read_receipts(user_id):
+    """Flush nel percorso di una richiesta: se il DB non risponde la pagina si apre lo stesso."""
+    try:
+        _flush_read_receipts(user_id)
+    except Exception as e:
+        # Le conferme sono già tornate nel buffer: le riscrive il flush periodico
+        print(f"⚠️ Conferme di lettura non scritte: {e}")
+        _schedule_read_receipt_flush()
+
+def _schedule_read_receipt_flush():
+    global _read_receipts_timer
+    with _read_receipts_lock:
+        if _read_receipts_timer is not None:
+            return
+        _read_receipts_timer = threading.Timer(app.config["READ_RECEIPT_FLUSH_SECONDS"], _flush_read_receipts_job)
+        _read_receipts_timer.daemon = True
+        _read_receipts_timer.start()
+
+def _flush_read_receipts_job():
+    global _read_receipts_timer
+    with _read_receipts_lock:
+        _read_receipts_timer = None
+    with app.app_context():
+        try:
+            _flush_read_receipts()
+        except Exception as e:
+            print(f"⚠️ Conferme di lettura non scritte: {e}")
+            _schedule_read_receipt_flush()
+
+@atexit.register
+def _flush_read_receipts_at_exit():
+    if _read_receipts:
+        with app.app_context():
+            _flush_read_receipts()
+
+# --- REGISTRO EVENTI TICKET ---
+# Ogni modifica a un ticket scrive un evento in ticket_events nella stessa transazione:
+# le integrazioni (BI, wallboard) leggono /api/events?after=<cursore> e ricevono solo
+# le modifiche successive, senza riesportare tutto. Tipi: creato (dati = ticket),
+# aggiornato (dati = {campo: [prima, dopo]}), commento, eliminato.
+app.config["EVENTS_TOKEN"] = os.environ.get("EVENTS_TOKEN", "")
+EVENTS_PAGE_MAX = 1000
+EVENTS_LOCK_KEY = 0x5167A  # advisory lock PostgreSQL degli scrittori di eventi
+EVENT_FIELDS = ("cinema", "cinema_id", "città", "sala", "tipo", "urgenza", "stato", "chiuso_da", "chiuso_il")
+
+def _event_value(v):
+    return v.isoformat() if isinstance(v, datetime) else v
+
+def _problem_snapshot(p):
+    """Campi del ticket per l'evento "creato" (da oggetto Problem o da dict dell'import)."""
+    get = p.get if isinstance(p, dict) else lambda f: getattr(p, f)
+    return {f: _event_value(get(f)) for f in EVENT_FIELDS + ("autore", "data_ora")}
+
+def _problem_changes(p):
+    """Campi modificati e non ancora salvati: {campo: [prima, dopo]}. Va chiamata prima del flush."""
+    state = db.inspect(p)
+    changes = {}
+    for field in EVENT_FIELDS:
+        hist = state.attrs[field].history
+        if hist.added:
+            before = hist.deleted[0] if hist.deleted else None
+            if hist.added[0] != before:
+                changes[field] = [_event_value(before), _event_value(hist.added[0])]
+    return changes
+
+def _lock_ticket_events():
+    """Serializza fino al commit le transazioni che scrivono eventi (solo PostgreSQL).
+
+    Così gli id degli eventi diventano visibili in ordine: chi ha già letto fino all'id N
+    non vedrà mai comparire dopo un evento < N committato in ritardo. Va chiamata all'inizio
+    di ogni scrittura con eventi, prima di modificare qualsiasi riga: preso sempre per primo,
+    il lock non può formare un ciclo con i lock di riga (deadlock). Su SQLite le scritture
+    sono già serializzate.
+    """
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(db.text("SELECT pg_advisory_xact_lock(:k)"), {"k": EVENTS_LOCK_KEY})
+
+def _record_events(rows):
+    """Aggiunge eventi alla transazione in corso: vengono salvati solo insieme alla modifica.
+
+    Il chiamante deve aver già preso _lock_ticket_events() prima di modificare i ticket.
+    """
+    if not rows:
+        return
+    base = {"data_ora": datetime.utcnow(),
+            "autore": session.get("username", "") if has_request_context() else ""}
+    db.session.execute(db.insert(TicketEvent), [dict(base, **r) for r in rows])
+
+def _record_event(problem_id, tipo, dati=None):
+    _record_events([{"problem_id": problem_id, "tipo": tipo, "dati": dati or {}}])
+
+def _bearer_authorized(token):
+    """Admin loggato, oppure header "Authorization: Bearer <token>" se il token è configurato."""
+    return session.get("role") == "admin" or bool(
+        token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"))
+
+@app.route("/api/events")
+def api_events():
+    """Feed delle modifiche: eventi con id > after in ordine crescente, al massimo limit per pagina."""
+    if not _bearer_authorized(app.config["EVENTS_TOKEN"]):
+        return {"error": "accesso negato"}, 403
+    try:
+        after = int(request.args.get("after", 0))
+        limit = min(max(int(request.args.get("limit", 500)), 1), EVENTS_PAGE_MAX)
+    except ValueError:
+        return {"error": "after e limit devono essere interi"}, 400
+    rows = db.session.execute(
+        db.select(TicketEvent.id, TicketEvent.problem_id, TicketEvent.tipo, TicketEvent.autore,
+                  TicketEvent.data_ora, TicketEvent.dati)
+        .where(TicketEvent.id > after).order_by(TicketEvent.id).limit(limit + 1)
+    ).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "events": [{"id": r.id, "problem_id": r.problem_id, "tipo": r.tipo, "autore": r.autore,
+                    "data_ora": r.data_ora.isoformat(), "dati": r.dati} for r in rows],
+        "cursor": rows[-1].id if rows else after,  # da passare come ?after= alla richiesta successiva
+        "has_more": has_more,
+    }
+
 # --- DETTAGLIO TICKET ---
 @app.route("/problems/<int:problem_id>", methods=["GET"])
 def ticket_detail(problem_id):
@@ -334,16 +1263,30 @@ def ticket_detail(problem_id):
     if session["role"] != "admin" and session["username"] != p.autore:
         return "Accesso negato", 403
     comments = Comment.query.filter_by(problem_id=p.id).order_by(Comment.data_ora.asc()).all()
-    # Segna il ticket come letto dall'utente corrente
-    tr = TicketRead.query.filter_by(user_id=session["user_id"], problem_id=p.id).first()
-    if tr:
-        tr.last_read_at = datetime.utcnow()
-    else:
-        db.session.add(TicketRead(user_id=session["user_id"], problem_id=p.id))
-    db.session.commit()
-    return render_template("ticket_detail.html", problem=p, comments=comments)
+    html = render_template("ticket_detail.html", problem=p, comments=comments)
+    _mark_read(p)  # dopo il render: il commit non fa ricaricare ticket e messaggi
+    return html
 
 # --- AGGIUNGI COMMENTO ---
+def _create_comment(p, testo):
+    _lock_ticket_events()
+    now = datetime.utcnow()
+    c = Comment(
+        problem_id=p.id,
+        autore=session["username"],
+        role=session["role"],
+        testo=testo,
+        data_ora=now,
+    )
+    db.session.add(c)
+    # Incremento atomico lato SQL: niente aggiornamenti persi tra worker
+    p.comment_count = Problem.comment_count + 1
+    p.last_comment_at = now
+    db.session.flush()
+    _record_event(p.id, "commento", {"comment_id": c.id, "role": c.role, "testo": testo})
+    db.session.commit()
+    return c
+
 @app.route("/problems/<int:problem_id>/comment", methods=["POST"])
 def add_comment(problem_id):
     if "user_id" not in session:
@@ -353,18 +1296,134 @@ def add_comment(problem_id):
         abort(404)
     if session["role"] != "admin" and session["username"] != p.autore:
         return "Accesso negato", 403
+    if p.stato == "Chiuso":
+        flash("Ticket chiuso — i messaggi sono disabilitati.", "warning")
+        return redirect(url_for("ticket_detail", problem_id=p.id))
     testo = request.form.get("testo", "").strip()
     if testo:
-        c = Comment(
-            problem_id=p.id,
-            autore=session["username"],
-            role=session["role"],
-            testo=testo,
-        )
-        db.session.add(c)
-        db.session.commit()
+        _create_comment(p, testo)
     return redirect(url_for("ticket_detail", problem_id=p.id) + "#chat-bottom")
 
+# --- CHAT LIVE (JSON + Server-Sent Events) ---
+# Ogni richiesta in attesa occupa un thread gunicorn (worker gthread). Di default la pagina
+# del ticket fa un long-poll breve (CHAT_LONGPOLL_SECONDS) e poi una pausa (CHAT_POLL_INTERVAL):
+# una scheda aperta tiene un thread solo per una frazione del tempo. Lo stream SSE tiene un
+# thread per scheda per CHAT_STREAM_SECONDS ed è attivo solo con CHAT_SSE=1 (vedi gunicorn.conf.py).
+app.config["CHAT_POLL_SECONDS"] = float(os.environ.get("CHAT_POLL_SECONDS", "2"))
+app.config["CHAT_LONGPOLL_SECONDS"] = float(os.environ.get("CHAT_LONGPOLL_SECONDS", "3"))
+app.config["CHAT_POLL_INTERVAL"] = float(os.environ.get("CHAT_POLL_INTERVAL", "5"))
+app.config["CHAT_SSE"] = os.environ.get("CHAT_SSE", "0") == "1"
+# Durata massima di uno stream SSE: poi il browser si riconnette (con Last-Event-ID)
+app.config["CHAT_STREAM_SECONDS"] = int(os.environ.get("CHAT_STREAM_SECONDS", "55"))
+
+def _comment_json(c):
+    return {
+        "id": c.id,
+        "autore": c.autore,
+        "role": c.role,
+        "testo": c.testo,
+        "data_ora": c.data_ora.isoformat(),
+        "ora": c.data_ora.strftime("%d/%m %H:%M"),
+    }
+
+def _comments_after(problem_id, after_id):
+    return (Comment.query
+            .filter(Comment.problem_id == problem_id, Comment.id > after_id)
+            .order_by(Comment.id.asc())
+            .all())
+
+def _chat_problem(problem_id):
+    """Ticket della chat con lo stesso controllo accessi delle pagine HTML, o una risposta d'errore."""
+    if "user_id" not in session:
+        return None, ({"error": "login richiesto"}, 401)
+    p = db.session.get(Problem, problem_id)
+    if not p:
+        return None, ({"error": "ticket non trovato"}, 404)
+    if session["role"] != "admin" and session["username"] != p.autore:
+        return None, ({"error": "accesso negato"}, 403)
+    return p, None
+
+def _after_id():
+    try:
+        return int(request.headers.get("Last-Event-ID") or request.args.get("after", 0))
+    except ValueError:
+        return 0
+
+@app.route("/problems/<int:problem_id>/comments", methods=["GET"])
+def comments_since(problem_id):
+    """Solo i commenti con id > ?after=. Con ?wait=N fa long-poll fino a N secondi."""
+    p, err = _chat_problem(problem_id)
+    if err:
+        return err
+    after = _after_id()
+    try:
+        wait = min(float(request.args.get("wait", 0)), app.config["CHAT_LONGPOLL_SECONDS"])
+    except ValueError:
+        wait = 0
+    deadline = time.monotonic() + wait
+    comments = _comments_after(p.id, after)
+    while not comments and time.monotonic() < deadline:
+        db.session.close()  # rilascia la connessione durante l'attesa
+        time.sleep(max(0.0, min(app.config["CHAT_POLL_SECONDS"], deadline - time.monotonic())))
+        comments = _comments_after(problem_id, after)
+    data = {"comments": [_comment_json(c) for c in comments]}
+    if comments:
+        p = db.session.get(Problem, problem_id)
+        if p is None:  # eliminato durante l'attesa
+            return {"error": "ticket non trovato"}, 404
+        _mark_read(p)  # messaggi visti nella chat aperta
+    return data
+
+@app.route("/problems/<int:problem_id>/comments", methods=["POST"])
+def post_comment_json(problem_id):
+    p, err = _chat_problem(problem_id)
+    if err:
+        return err
+    if p.stato == "Chiuso":
+        return {"error": "ticket chiuso"}, 409
+    data = request.get_json(silent=True) or {}
+    testo = str(data.get("testo", "")).strip()
+    if not testo:
+        return {"error": "testo obbligatorio"}, 400
+    data = _comment_json(_create_comment(p, testo))
+    _mark_read(p)  # il proprio messaggio non deve risultare "non letto"
+    return data, 201
+
+@app.route("/problems/<int:problem_id>/comments/stream")
+def comments_stream(problem_id):
+    """Server-Sent Events: invia solo i commenti nuovi rispetto all'ultimo id visto."""
+    if not app.config["CHAT_SSE"]:
+        return {"error": "stream disattivato (CHAT_SSE=0)"}, 404
+    p, err = _chat_problem(problem_id)
+    if err:
+        return err
+    pid = p.id
+    after = _after_id()
+    db.session.close()
+
+    @stream_with_context
+    def events():
+        last = after
+        deadline = time.monotonic() + app.config["CHAT_STREAM_SECONDS"]
+        yield "retry: 3000\n\n"
+        while time.monotonic() < deadline:
+            comments = _comments_after(pid, last)
+            for c in comments:
+                last = c.id
+                yield f"id: {c.id}\nevent: comment\ndata: {json.dumps(_comment_json(c))}\n\n"
+            if comments:
+                p = db.session.get(Problem, pid)
+                if p is None:  # eliminato durante lo stream: il client chiude l'EventSource
+                    yield "event: deleted\ndata: {}\n\n"
+                    return
+                _mark_read(p)
+            db.session.close()  # nessuna connessione DB trattenuta tra un poll e l'altro
+            yield ": ping\n\n"
+            time.sleep(app.config["CHAT_POLL_SECONDS"])
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # --- AGGIORNA TICKET (stato/urgenza) ---
 @app.route("/problems/<int:problem_id>/update", methods=["POST"])
 def update_ticket(problem_id):
@@ -377,6 +1436,7 @@ def update_ticket(problem_id):
         return "Accesso negato", 403
     nuovo_stato   = request.form.get("stato", p.stato)
     nuova_urgenza = request.form.get("urgenza", p.urgenza)
+    _lock_ticket_events()
     if nuovo_stato == "Chiuso" and p.stato != "Chiuso":
         p.chiuso_da = session["username"]
         p.chiuso_il = datetime.utcnow()
@@ -385,6 +1445,9 @@ def update_ticket(problem_id):
         p.chiuso_il = None
     p.stato   = nuovo_stato
     p.urgenza = nuova_urgenza
+    changes = _problem_changes(p)
+    if changes:
+        _record_event(p.id, "aggiornato", changes)
     db.session.commit()
     flash("Ticket aggiornato.", "success")
     if nuovo_stato == "Chiuso":
@@ -399,8 +1462,91 @@ def closed_tickets():
     query = Problem.query.filter_by(stato="Chiuso")
     if session["role"] != "admin":
         query = query.filter_by(autore=session["username"])
-    problems = query.order_by(Problem.data_ora.desc()).all()
-    return render_template("closed_tickets.html", problems=problems)
+    problems, next_cursor, prev_cursor = _keyset_page(query)
+    return render_template("closed_tickets.html", problems=problems,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+# --- RICERCA FULL-TEXT ---
+# L'indice è mantenuto dal database a ogni scrittura (vedi migrazione 10), anche per
+# gli INSERT a blocchi dell'import: qui si legge soltanto.
+SEARCH_CONFIG = "italian"
+_HL_START, _HL_STOP = "\x02", "\x03"
+
+def _search_terms(q):
+    """Parole della ricerca (al massimo 8): tutte devono comparire, anche come prefisso."""
+    return re.findall(r"\w+", q.lower())[:8]
+
+def _search_matches(terms):
+    """(sottoquery id ticket con i termini in tipo, sottoquery id ticket con i termini nella chat)."""
+    if db.engine.dialect.name == "postgresql":
+        tsq = db.func.to_tsquery(SEARCH_CONFIG, " & ".join(f"{t}:*" for t in terms))
+        in_tipo = db.select(Problem.id).where(db.literal_column("problems.search_vector").op("@@")(tsq))
+        in_chat = db.select(Comment.problem_id).where(db.literal_column("comments.search_vector").op("@@")(tsq))
+        return in_tipo, in_chat
+    match = " ".join(f'"{t}"*' for t in terms)
+    in_tipo = (db.text("SELECT rowid FROM problems_fts WHERE problems_fts MATCH :m_tipo")
+               .bindparams(m_tipo=match).columns(rowid=db.Integer))
+    in_chat = db.select(Comment.problem_id).where(Comment.id.in_(
+        db.text("SELECT rowid FROM comments_fts WHERE comments_fts MATCH :m_chat")
+        .bindparams(m_chat=match).columns(rowid=db.Integer)))
+    return in_tipo, in_chat
+
+def _search_snippets(terms, ids):
+    """Estratti evidenziati solo per i ticket della pagina: {id: {"tipo": ..., "chat": (autore, ...)}}."""
+    snippets = {pid: {"tipo": None, "chat": None} for pid in ids}
+    if not ids:
+        return snippets
+    ids_param = db.bindparam("ids", expanding=True)
+    if db.engine.dialect.name == "postgresql":
+        opts = f"StartSel={_HL_START}, StopSel={_HL_STOP}, MaxWords=25, MinWords=8, MaxFragments=2"
+        tsq = "to_tsquery(:cfg, :q)"
+        params = {"cfg": SEARCH_CONFIG, "q": " & ".join(f"{t}:*" for t in terms), "ids": ids, "opts": opts}
+        tipo_sql = (f"SELECT id, ts_headline(:cfg, tipo, {tsq}, :opts) FROM problems "
+                    f"WHERE id IN :ids AND search_vector @@ {tsq}")
+        chat_sql = (f"SELECT DISTINCT ON (problem_id) problem_id, autore, ts_headline(:cfg, testo, {tsq}, :opts) "
+                    f"FROM comments WHERE problem_id IN :ids AND search_vector @@ {tsq} "
+                    f"ORDER BY problem_id, data_ora DESC")
+    else:
+        params = {"m": " ".join(f'"{t}"*' for t in terms), "ids": ids,
+                  "a": _HL_START, "b": _HL_STOP}
+        tipo_sql = ("SELECT rowid, snippet(problems_fts, 0, :a, :b, '…', 24) FROM problems_fts "
+                    "WHERE problems_fts MATCH :m AND rowid IN :ids")
+        chat_sql = ("SELECT c.problem_id, c.autore, snippet(comments_fts, 0, :a, :b, '…', 24) "
+                    "FROM comments_fts JOIN comments c ON c.id = comments_fts.rowid "
+                    "WHERE comments_fts MATCH :m AND c.problem_id IN :ids ORDER BY c.data_ora DESC")
+    for pid, text in db.session.execute(db.text(tipo_sql).bindparams(ids_param), params):
+        snippets[pid]["tipo"] = _highlight(text)
+    for pid, autore, text in db.session.execute(db.text(chat_sql).bindparams(ids_param), params):
+        if snippets[pid]["chat"] is None:  # il messaggio più recente che corrisponde
+            snippets[pid]["chat"] = (autore, _highlight(text))
+    return snippets
+
+def _highlight(text):
+    """Testo dell'estratto con HTML escapato e i termini trovati in <mark>."""
+    return Markup(str(escape(text)).replace(_HL_START, "<mark>").replace(_HL_STOP, "</mark>"))
+
+@app.route("/search")
+def search():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    q = request.args.get("q", "").strip()
+    filter_stato = request.args.get("stato", "")
+    terms = _search_terms(q)
+    problems, next_cursor, prev_cursor, snippets = [], None, None, {}
+    if terms:
+        in_tipo, in_chat = _search_matches(terms)
+        query = Problem.query.filter(db.or_(Problem.id.in_(in_tipo), Problem.id.in_(in_chat)))
+        # Stesso scope della dashboard: l'utente vede solo i propri ticket
+        if session["role"] != "admin":
+            query = query.filter_by(autore=session["username"])
+        if filter_stato == "aperti":
+            query = query.filter(Problem.stato != "Chiuso")
+        elif filter_stato == "chiusi":
+            query = query.filter_by(stato="Chiuso")
+        problems, next_cursor, prev_cursor = _keyset_page(query)
+        snippets = _search_snippets(terms, [p.id for p in problems])
+    return render_template("search.html", q=q, filter_stato=filter_stato, problems=problems,
+                           snippets=snippets, next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 # --- AGGIUNGI PROBLEMA ---
 @app.route("/problems/add", methods=["POST"])
@@ -419,19 +1565,25 @@ def add_problem():
         return redirect(url_for("dashboard"))
 
     # Recupera città dal cinema selezionato
-    cinema_obj = Cinema.query.filter_by(nome=cinema_nome).first()
+    cinema_obj = cinema_catalog()["by_name"].get(cinema_nome)
     città = cinema_obj.città if cinema_obj else ""
 
     p = Problem(
         cinema=cinema_nome,
+        cinema_id=cinema_obj.id if cinema_obj else None,
         città=città,
         sala=sala,
         tipo=tipo,
         urgenza=urgenza,
         stato=stato,
         autore=session["username"],
+        data_ora=datetime.utcnow(),
     )
+    p.update_fingerprint()
+    _lock_ticket_events()
     db.session.add(p)
+    db.session.flush()
+    _record_event(p.id, "creato", _problem_snapshot(p))
     db.session.commit()
     flash("Problema aggiunto con successo.", "success")
     return redirect(url_for("dashboard"))
@@ -450,16 +1602,22 @@ def edit_problem(problem_id):
         return "Accesso negato", 403
 
     if request.method == "POST":
+        _lock_ticket_events()
         p.cinema = request.form.get("cinema", p.cinema)
+        cinema_obj = cinema_catalog()["by_name"].get(p.cinema)
+        p.cinema_id = cinema_obj.id if cinema_obj else None
         p.tipo = request.form.get("tipo", p.tipo)
         p.urgenza = request.form.get("urgenza", p.urgenza)
         p.stato = request.form.get("stato", p.stato)
+        p.update_fingerprint()
+        changes = _problem_changes(p)
+        if changes:
+            _record_event(p.id, "aggiornato", changes)
         db.session.commit()
         flash("Problema aggiornato con successo.", "success")
         return redirect(url_for("dashboard"))
 
-    cinemas = Cinema.query.order_by(Cinema.nome.asc()).all()
-    return render_template("edit_problem.html", problem=p, cinemas=cinemas)
+    return render_template("edit_problem.html", problem=p, cinemas=cinema_catalog()["by_nome"])
 
 # --- ARCHIVIA PROBLEMA (ex elimina) ---
 @app.route("/problems/<int:problem_id>/delete", methods=["POST"])
@@ -474,7 +1632,11 @@ def delete_problem(problem_id):
     if session["role"] != "admin" and session["username"] != p.autore:
         return "Accesso negato", 403
 
+    _lock_ticket_events()
     p.stato = "Chiuso"
+    changes = _problem_changes(p)
+    if changes:
+        _record_event(p.id, "aggiornato", changes)
     db.session.commit()
     flash("Ticket archiviato.", "success")
     return redirect(url_for("dashboard"))
@@ -489,7 +1651,9 @@ def destroy_problem(problem_id):
     p = db.session.get(Problem, problem_id)
     if not p:
         abort(404)
+    _lock_ticket_events()
     db.session.delete(p)
+    _record_event(p.id, "eliminato")
     db.session.commit()
     flash("Ticket eliminato definitivamente.", "success")
     return redirect(url_for("closed_tickets"))
@@ -516,7 +1680,7 @@ def admin_users():
             flash("Username già in uso.", "warning")
             return redirect(url_for("admin_users"))
 
-        u = User(username=username, role=role, password_hash=generate_password_hash(password),
+        u = User(username=username, role=role, password_hash=hash_password(password),
                  password_plain=password, telefono=telefono, email=email)
         db.session.add(u)
         db.session.commit()
@@ -545,7 +1709,7 @@ def user_detail(user_id):
         db.session.commit()
         flash(f"Cinema assegnati a '{u.username}' aggiornati.", "success")
         return redirect(url_for("user_detail", user_id=u.id))
-    all_cinemas = Cinema.query.order_by(Cinema.città.asc(), Cinema.nome.asc()).all()
+    all_cinemas = cinema_catalog()["by_città"]
     assigned_ids = {uc.cinema_id for uc in UserCinema.query.filter_by(user_id=u.id).all()}
     return render_template("user_detail.html", u=u, all_cinemas=all_cinemas, assigned_ids=assigned_ids)
 
@@ -564,7 +1728,7 @@ def reset_password(user_id):
     if not u:
         abort(404)
 
-    u.password_hash = generate_password_hash(new_password)
+    u.password_hash = hash_password(new_password)
     u.password_plain = new_password
     db.session.commit()
     flash(f"Password di '{u.username}' aggiornata con successo.", "success")
@@ -609,22 +1773,31 @@ def admin_cinemas():
         except ValueError:
             num_sale = 1
         if nome:
+            _lock_ticket_events()
             db.session.add(Cinema(nome=nome, città=città, num_sale=num_sale,
                                   telefono=telefono, indirizzo=indirizzo))
+            db.session.flush()
+            _link_cinema_tickets()  # ticket già aperti con questo nome (anche dopo un'eliminazione)
+            _bump_cinema_catalog()
             db.session.commit()
             flash(f"Cinema '{nome}' ({città}) aggiunto.", "success")
         return redirect(url_for("admin_cinemas"))
-    cinemas = Cinema.query.order_by(Cinema.città.asc(), Cinema.nome.asc()).all()
-    # Ticket aperti raggruppati per nome cinema
-    _urgency_order = {"Critico": 0, "Urgente": 1, "Non urgente": 2}
-    open_problems = Problem.query.filter(Problem.stato != "Chiuso").all()
-    open_problems.sort(key=lambda p: _urgency_order.get(p.urgenza, 9))
-    tickets_map = {}
-    for p in open_problems:
-        key = (p.cinema or "").strip()
-        if key:
-            tickets_map.setdefault(key, []).append(p)
-    return render_template("cinemas.html", cinemas=cinemas, tickets_map=tickets_map)
+    # Solo i conteggi: mappa e liste ticket arrivano dalle API (/api/cinemas.geojson)
+    return render_template("cinemas.html", cinemas=cinema_catalog()["by_città"],
+                           counts=_open_ticket_counts())
+
+def _link_cinema_tickets():
+    """_link_problems_to_cinemas dalle pagine admin, con un evento per ogni ticket collegato.
+
+    Il chiamante ha già preso _lock_ticket_events() e fatto il flush del cinema.
+    """
+    match = (db.select(db.func.min(Cinema.id)).where(Cinema.nome == db.func.trim(Problem.cinema))
+             .scalar_subquery())
+    rows = db.session.execute(
+        db.select(Problem.id, match).where(Problem.cinema_id.is_(None), match.is_not(None))).all()
+    _record_events([{"problem_id": pid, "tipo": "aggiornato", "dati": {"cinema_id": [None, cid]}}
+                    for pid, cid in rows])
+    _link_problems_to_cinemas(db.session.connection())
 
 @app.route("/admin/cinemas/<int:cinema_id>/edit", methods=["GET", "POST"])
 def edit_cinema(cinema_id):
@@ -650,6 +1823,24 @@ def edit_cinema(cinema_id):
             lat = None
             lng = None
         if nuovo_nome:
+            renamed = (nuovo_nome, nuova_città) != (c.nome, c.città)
+            if renamed:
+                # I ticket seguono il cinema rinominato (collegati per cinema_id)
+                _lock_ticket_events()
+                rows = db.session.execute(
+                    db.select(Problem.id, Problem.cinema, Problem.città).where(Problem.cinema_id == c.id)).all()
+                events = []
+                for r in rows:
+                    dati = {f: [old, new] for f, old, new in (("cinema", r.cinema, nuovo_nome),
+                                                             ("città", r.città, nuova_città)) if old != new}
+                    if dati:
+                        events.append({"problem_id": r.id, "tipo": "aggiornato", "dati": dati})
+                _record_events(events)
+                db.session.execute(
+                    db.update(Problem).where(Problem.cinema_id == c.id)
+                    .values(cinema=nuovo_nome, città=nuova_città, fingerprint=None)
+                )
+                _fill_missing_fingerprints(db.session.connection())
             c.nome = nuovo_nome
             c.città = nuova_città
             c.num_sale = num_sale
@@ -657,6 +1848,10 @@ def edit_cinema(cinema_id):
             c.indirizzo = request.form.get("indirizzo", "").strip()
             c.lat = lat
             c.lng = lng
+            if renamed:
+                db.session.flush()
+                _link_cinema_tickets()  # ticket non collegati che riportano già il nuovo nome
+            _bump_cinema_catalog()
             db.session.commit()
             flash(f"Cinema '{nuovo_nome}' aggiornato.", "success")
         return redirect(url_for("admin_cinemas"))
@@ -669,104 +1864,561 @@ def delete_cinema(cinema_id):
     c = db.session.get(Cinema, cinema_id)
     if c:
         nome = c.nome
+        # Su SQLite le FK non sono applicate: scollega i ticket esplicitamente (il nome resta)
+        _lock_ticket_events()
+        linked = db.session.execute(db.select(Problem.id).where(Problem.cinema_id == c.id)).scalars().all()
+        _record_events([{"problem_id": pid, "tipo": "aggiornato", "dati": {"cinema_id": [c.id, None]}}
+                        for pid in linked])
+        db.session.execute(db.update(Problem).where(Problem.cinema_id == c.id).values(cinema_id=None))
         db.session.delete(c)
         if not DeletedCinema.query.filter_by(nome=nome).first():
             db.session.add(DeletedCinema(nome=nome))
+        _bump_cinema_catalog()
         db.session.commit()
         flash(f"Cinema '{nome}' eliminato.", "success")
     return redirect(url_for("admin_cinemas"))
 
-# --- EXPORT EXCEL ---
-@app.route("/export/excel")
-def export_excel():
+# --- API CINEMA (mappa) ---
+URGENZE = ("Critico", "Urgente", "Non urgente")
+
+def _open_ticket_counts(autore=None, cinema_ids=None):
+    """Ticket aperti per cinema_id e urgenza, aggregati in SQL: {cinema_id: {urgenza: n}}."""
+    counts = {}
+    q = (db.select(Problem.cinema_id, Problem.urgenza, db.func.count(Problem.id))
+         .where(Problem.cinema_id.is_not(None), Problem.stato != "Chiuso")
+         .group_by(Problem.cinema_id, Problem.urgenza))
+    if autore is not None:
+        q = q.where(Problem.autore == autore)
+    if cinema_ids is not None:
+        q = q.where(Problem.cinema_id.in_(cinema_ids))
+    rows = db.session.execute(q)
+    for cid, urgenza, n in rows:
+        per_cinema = counts.setdefault(cid, dict.fromkeys(URGENZE, 0))
+        per_cinema[urgenza] = per_cinema.get(urgenza, 0) + n
+    return counts
+
+def _cinema_tickets_etag(cinema_id=None):
+    """Versione dei ticket aperti collegati ai cinema (o a uno solo) + versione del catalogo."""
+    q = (db.select(db.func.count(Problem.id), db.func.max(Problem.id), db.func.max(Problem.updated_at))
+         .where(Problem.cinema_id.is_not(None), Problem.stato != "Chiuso"))
+    if cinema_id is not None:
+        q = q.where(Problem.cinema_id == cinema_id)
+    version = db.session.execute(q).one()
+    raw = f"{cinema_catalog()['version']}|{cinema_id}|{tuple(version)}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+@app.route("/api/cinemas.geojson")
+def api_cinemas_geojson():
+    """Cinema con coordinate come FeatureCollection, con i conteggi dei ticket aperti per urgenza."""
+    if session.get("role") != "admin":
+        return {"error": "Accesso negato"}, 403
+    def build():
+        counts = _open_ticket_counts()
+        features = []
+        for c in cinema_catalog()["by_città"]:
+            if c.lat is None or c.lng is None:
+                continue
+            per_urgenza = counts.get(c.id, dict.fromkeys(URGENZE, 0))
+            features.append({
+                "type": "Feature",
+                "id": c.id,
+                "geometry": {"type": "Point", "coordinates": [c.lng, c.lat]},
+                "properties": {
+                    "nome": c.nome, "città": c.città, "num_sale": c.num_sale,
+                    "telefono": c.telefono or "", "indirizzo": c.indirizzo or "",
+                    "aperti": sum(per_urgenza.values()),
+                    "urgenza": per_urgenza,
+                    "tickets_url": url_for("api_cinema_tickets", cinema_id=c.id),
+                },
+            })
+        return {"type": "FeatureCollection", "features": features}
+    return _conditional_json(_cinema_tickets_etag(), build, mimetype="application/geo+json")
+
+@app.route("/api/cinemas/<int:cinema_id>/tickets")
+def api_cinema_tickets(cinema_id):
+    """Ticket aperti di un cinema, caricati solo quando se ne apre il popup o il dettaglio."""
+    if session.get("role") != "admin":
+        return {"error": "Accesso negato"}, 403
+    c = cinema_catalog()["by_id"].get(cinema_id)
+    if not c:
+        abort(404)
+    def build():
+        urgency_order = db.case({u: i for i, u in enumerate(URGENZE)}, value=Problem.urgenza, else_=9)
+        rows = db.session.execute(
+            db.select(Problem.id, Problem.sala, Problem.tipo, Problem.urgenza)
+            .where(Problem.cinema_id == cinema_id, Problem.stato != "Chiuso")
+            .order_by(urgency_order, Problem.data_ora.desc())
+        )
+        return {
+            "cinema_id": c.id,
+            "nome": c.nome,
+            "tickets": [{"id": r.id, "sala": r.sala, "tipo": r.tipo, "urgenza": r.urgenza,
+                         "url": url_for("ticket_detail", problem_id=r.id)} for r in rows],
+        }
+    return _conditional_json(_cinema_tickets_etag(cinema_id), build)
+
+def _float_arg(name, default=None, lo=None, hi=None):
+    """Parametro numerico della query string (400 se non valido o fuori intervallo)."""
+    raw = request.args.get(name, "").strip()
+    if not raw:
+        return default
+    try:
+        value = float(raw)
+    except ValueError:
+        abort(400)
+    if not math.isfinite(value) or (lo is not None and value < lo) or (hi is not None and value > hi):
+        abort(400)
+    return value
+
+@app.route("/api/cinemas/near")
+def api_cinemas_near():
+    """Cinema più vicini a un punto (lat/lng) o a un cinema (cinema_id), con i ticket aperti.
+
+    k=N per i più vicini, radius_km=R per un raggio (insieme: i k più vicini entro R);
+    urgenza=Critico tiene solo i cinema con ticket aperti di quell'urgenza.
+    """
     if "user_id" not in session:
-        return redirect(url_for("login"))
+        return {"error": "login richiesto"}, 401
+    catalog = cinema_catalog()
+    origin_id = request.args.get("cinema_id", type=int)
+    if origin_id is not None:
+        origin = catalog["by_id"].get(origin_id)
+        if not origin or origin.lat is None or origin.lng is None:
+            abort(404)
+        lat, lng = origin.lat, origin.lng
+    else:
+        lat, lng = _float_arg("lat", lo=-90, hi=90), _float_arg("lng", lo=-180, hi=180)
+        if lat is None or lng is None:
+            return {"error": "servono lat e lng oppure cinema_id"}, 400
+    radius_km = _float_arg("radius_km", lo=0, hi=2000)
+    k = request.args.get("k", type=int) or (None if radius_km is not None else 5)
+    k = max(1, min(k, 100)) if k else None
+    urgenza = request.args.get("urgenza", "")
+    if urgenza and urgenza not in URGENZE:
+        return {"error": "urgenza non valida"}, 400
+
+    visible = _visible_cinema_ids(session["user_id"])
+    counts = _open_ticket_counts(autore=None if session["role"] == "admin" else session["username"],
+                                 cinema_ids=visible)
+    def where(c):
+        if c.id == origin_id or (visible is not None and c.id not in visible):
+            return False
+        return not urgenza or counts.get(c.id, {}).get(urgenza, 0) > 0
+
+    geo = catalog["geo"]
+    if k is None:
+        found = geo.within(lat, lng, radius_km, where)
+    else:
+        found = geo.nearest(lat, lng, k, where, max_km=radius_km)
+    empty = dict.fromkeys(URGENZE, 0)
+    return {
+        "origin": {"lat": lat, "lng": lng, "cinema_id": origin_id},
+        "results": [{
+            "id": c.id, "nome": c.nome, "città": c.città, "lat": c.lat, "lng": c.lng,
+            "distanza_km": round(d, 2),
+            "aperti": sum(counts.get(c.id, empty).values()),
+            "urgenza": counts.get(c.id, empty),
+        } for d, c in found],
+    }
 
-    is_admin = session["role"] == "admin"
-    username = session["username"]
-    foglio   = request.args.get("foglio", "tutto")  # aperti | chiusi | cinema | utenti | tutto
+# --- EXPORT EXCEL ---
+EXPORT_BATCH = 1000          # righe lette dal DB per batch (yield_per)
+EXPORT_WIDTH_SAMPLE = 200    # righe campionate per stimare la larghezza delle colonne
+EXPORT_NAMES = {"aperti": "ticket_aperti", "chiusi": "archivio_chiusi",
+                "cinema": "cinema", "utenti": "utenti", "tutto": "completo"}
+
+def _fmt_dt(dt):
+    return dt.strftime("%d/%m/%Y %H:%M") if dt else ""
+
+def _export_sheets(foglio, is_admin, username):
+    """Fogli da esportare come (titolo, intestazioni, generatore di righe).
+
+    Le righe vengono lette a batch con yield_per come tuple di colonne,
+    senza materializzare oggetti ORM né l'intero risultato in memoria.
+    """
+    def stream(stmt, to_row):
+        result = db.session.execute(stmt.execution_options(yield_per=EXPORT_BATCH))
+        for r in result:
+            yield to_row(r)
+
+    sheets = []
+    if foglio in ("aperti", "tutto"):
+        q = (db.select(Problem.id, Problem.cinema, Problem.città, Problem.sala, Problem.tipo,
+                       Problem.urgenza, Problem.stato, Problem.autore, Problem.data_ora)
+             .where(Problem.stato != "Chiuso"))
+        if not is_admin:
+            q = q.where(Problem.autore == username)
+        q = q.order_by(Problem.data_ora.desc(), Problem.id.desc())
+        sheets.append(("Ticket Aperti",
+                       ["ID", "Cinema", "Città", "Sala", "Descrizione", "Urgenza", "Stato", "Autore", "Data apertura"],
+                       stream(q, lambda r: [*r[:8], _fmt_dt(r[8])])))
 
-    wb = openpyxl.Workbook()
+    if foglio in ("chiusi", "tutto"):
+        q = (db.select(Problem.id, Problem.cinema, Problem.città, Problem.sala, Problem.tipo,
+                       Problem.urgenza, Problem.autore, Problem.data_ora, Problem.chiuso_da, Problem.chiuso_il)
+             .where(Problem.stato == "Chiuso"))
+        if not is_admin:
+            q = q.where(Problem.autore == username)
+        q = q.order_by(Problem.data_ora.desc(), Problem.id.desc())
+        sheets.append(("Archivio Chiusi",
+                       ["ID", "Cinema", "Città", "Sala", "Descrizione", "Urgenza", "Autore", "Data apertura", "Chiuso da", "Chiuso il"],
+                       stream(q, lambda r: [*r[:7], _fmt_dt(r[7]), r[8] or "", _fmt_dt(r[9])])))
+
+    if foglio in ("cinema", "tutto") and is_admin:
+        q = (db.select(Cinema.id, Cinema.nome, Cinema.città, Cinema.num_sale, Cinema.telefono,
+                       Cinema.indirizzo, Cinema.lat, Cinema.lng)
+             .order_by(Cinema.città.asc(), Cinema.nome.asc()))
+        sheets.append(("Cinema",
+                       ["ID", "Nome", "Città", "Sale", "Telefono", "Indirizzo", "Lat", "Lng"],
+                       stream(q, lambda r: [r[0], r[1], r[2], r[3], r[4] or "", r[5] or "", r[6] or "", r[7] or ""])))
 
+    if foglio in ("utenti", "tutto") and is_admin:
+        q = db.select(User.id, User.username, User.role, User.email, User.telefono).order_by(User.id.asc())
+        # Cinema assegnati con una sola query: gli utenti sono pochi rispetto ai ticket
+        by_id = cinema_catalog()["by_id"]
+        assigned = {}
+        for uid, cid in db.session.execute(db.select(UserCinema.user_id, UserCinema.cinema_id)):
+            if cid in by_id:
+                assigned.setdefault(uid, []).append(by_id[cid].nome)
+        sheets.append(("Utenti",
+                       ["ID", "Username", "Ruolo", "Email", "Telefono", "Cinema"],
+                       stream(q, lambda r: [r[0], r[1], r[2], r[3] or "", r[4] or "",
+                                            "; ".join(sorted(assigned.get(r[0], [])))])))
+    return sheets
+
+def _write_workbook(sheets, fileobj):
+    """Scrive i fogli in modalità write-only di openpyxl (memoria costante).
+
+    In write-only le larghezze vanno impostate prima delle righe: si stimano
+    sulle prime EXPORT_WIDTH_SAMPLE righe invece di ripercorrere ogni cella.
+    """
+    wb = openpyxl.Workbook(write_only=True)
     header_font  = Font(bold=True, color="FFFFFF")
     header_fill  = PatternFill("solid", fgColor="1F2937")
     center_align = Alignment(horizontal="center", vertical="center")
 
-    def style_header(ws, headers):
-        ws.append(headers)
-        for cell in ws[1]:
+    for title, headers, rows in sheets:
+        ws = wb.create_sheet(title)
+        sample = []
+        for row in rows:
+            sample.append(row)
+            if len(sample) >= EXPORT_WIDTH_SAMPLE:
+                break
+        for i, header in enumerate(headers):
+            max_len = max([len(str(header))] + [len(str(r[i])) for r in sample if r[i]])
+            ws.column_dimensions[get_column_letter(i + 1)].width = min(max_len + 4, 60)
+        header_cells = []
+        for header in headers:
+            cell = WriteOnlyCell(ws, value=header)
             cell.font      = header_font
             cell.fill      = header_fill
             cell.alignment = center_align
+            header_cells.append(cell)
+        ws.append(header_cells)
+        for row in sample:
+            ws.append(row)
+        for row in rows:
+            ws.append(row)
+    if not sheets:
+        wb.create_sheet("Export")
+    wb.save(fileobj)
+
+# --- EXPORT IN BACKGROUND + CACHE ---
+# Gli xlsx finiti sono salvati su disco con chiave (fogli, scope utente, versione dati):
+# un export ripetuto su dati invariati viene servito subito dalla cache. Anche lo stato
+# dei job è un file JSON, così qualunque worker gunicorn può rispondere al polling.
+app.config["EXPORT_CACHE_DIR"] = os.environ.get(
+    "EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "sigrafilm_exports"))
+app.config["EXPORT_CACHE_MAX_MB"] = int(os.environ.get("EXPORT_CACHE_MAX_MB", "200"))
+app.config["EXPORT_WORKERS"] = int(os.environ.get("EXPORT_WORKERS", "2"))
+
+_export_executor = None
+_export_lock = threading.Lock()
+_export_running = {}  # cache_key -> job_id dei job in corso in questo processo
+
+def _export_dir(*parts):
+    path = os.path.join(app.config["EXPORT_CACHE_DIR"], *parts)
+    os.makedirs(os.path.dirname(path) if parts else path, exist_ok=True)
+    return path
+
+def _export_cache_key(foglio, is_admin, username):
+    """Chiave del file in cache: cambia appena cambiano i dati visibili all'utente."""
+    scope = "admin" if is_admin else f"user:{username}"
+    parts = [foglio, scope]
+    if foglio in ("aperti", "chiusi", "tutto"):
+        q = db.select(db.func.count(Problem.id), db.func.max(Problem.id), db.func.max(Problem.updated_at))
+        if not is_admin:
+            q = q.where(Problem.autore == username)
+        parts.append(str(tuple(db.session.execute(q).one())))
+    if is_admin and foglio in ("cinema", "tutto"):
+        parts.append(f"cinemas:{cinema_catalog()['version']}")
+    if is_admin and foglio in ("utenti", "tutto"):
+        parts.append(str(db.session.execute(
+            db.select(User.id, User.username, User.role, User.email, User.telefono).order_by(User.id)).all()))
+        parts.append(str(db.session.execute(
+            db.select(UserCinema.user_id, UserCinema.cinema_id)
+            .order_by(UserCinema.user_id, UserCinema.cinema_id)).all()))
+        parts.append(f"cinemas:{cinema_catalog()['version']}")  # nomi dei cinema assegnati
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:32]
+
+def _export_cached_path(cache_key):
+    path = _export_dir("files", f"{cache_key}.xlsx")
+    if os.path.exists(path):
+        os.utime(path)  # LRU: l'ultimo accesso è la mtime
+        return path
+    return None
+
+def _build_export(foglio, is_admin, username, cache_key):
+    """Genera l'xlsx nella cache (scrittura atomica) e applica l'eviction."""
+    path = _export_dir("files", f"{cache_key}.xlsx")
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp, "wb") as fh:
+            _write_workbook(_export_sheets(foglio, is_admin, username), fh)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    _evict_export_cache(keep=path)
+    return path
+
+def _evict_export_cache(keep=None):
+    """Elimina i file meno usati di recente oltre EXPORT_CACHE_MAX_MB e i job vecchi."""
+    limit = app.config["EXPORT_CACHE_MAX_MB"] * 1024 * 1024
+    files = []
+    for entry in os.scandir(_export_dir("files", "")):
+        if entry.name.endswith(".xlsx"):
+            st = entry.stat()
+            files.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    cutoff = time.time() - 86400
+    for entry in os.scandir(_export_dir("jobs", "")):
+        if entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
 
-    def autowidth(ws):
-        for col in ws.columns:
-            max_len = max((len(str(c.value)) if c.value else 0) for c in col)
-            ws.column_dimensions[col[0].column_letter].width = min(max_len + 4, 60)
+def _save_job(job):
+    path = _export_dir("jobs", f"{job['id']}.json")
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(job, fh)
+    os.replace(tmp, path)
 
-    def fmt(dt):
-        return dt.strftime("%d/%m/%Y %H:%M") if dt else ""
+def _load_job(job_id):
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        return None
+    try:
+        with open(_export_dir("jobs", f"{job_id}.json")) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
 
-    first_sheet = True
+def _run_export_job(job, is_admin):
+    with app.app_context():
+        try:
+            job["status"] = "running"
+            _save_job(job)
+            job["path"] = _build_export(job["foglio"], is_admin, job["username"], job["cache_key"])
+            job["status"] = "done"
+        except Exception as e:
+            job["status"] = "error"
+            job["error"] = str(e)
+        finally:
+            _save_job(job)
+            with _export_lock:
+                _export_running.pop(job["cache_key"], None)
+
+def _submit_export_job(foglio, is_admin, username, user_id):
+    global _export_executor
+    cache_key = _export_cache_key(foglio, is_admin, username)
+    now = datetime.now().strftime("%Y%m%d_%H%M")
+    job = {
+        "id": uuid.uuid4().hex, "user_id": user_id, "username": username,
+        "foglio": foglio, "cache_key": cache_key, "status": "queued", "path": None, "error": None,
+        "download_name": f"sigrafilm_{EXPORT_NAMES.get(foglio, foglio)}_{now}.xlsx",
+    }
+    cached = _export_cached_path(cache_key)
+    if cached:
+        job.update(status="done", path=cached)
+        _save_job(job)
+        return job
+    with _export_lock:
+        running = _export_running.get(cache_key)
+        if running:
+            existing = _load_job(running)
+            if existing and existing["user_id"] == user_id:
+                return existing
+        if _export_executor is None:
+            _export_executor = ThreadPoolExecutor(max_workers=app.config["EXPORT_WORKERS"],
+                                                  thread_name_prefix="export")
+        _export_running[cache_key] = job["id"]
+        _save_job(job)
+    _export_executor.submit(_run_export_job, dict(job), is_admin)
+    return job
+
+def _job_json(job):
+    data = {"job_id": job["id"], "status": job["status"], "error": job["error"]}
+    if job["status"] == "done":
+        data["download_url"] = url_for("export_job_download", job_id=job["id"])
+    return data
 
-    def new_sheet(title):
-        nonlocal first_sheet
-        if first_sheet:
-            ws = wb.active
-            ws.title = title
-            first_sheet = False
-        else:
-            ws = wb.create_sheet(title)
-        return ws
+@app.route("/export/excel")
+def export_excel():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
 
-    if foglio in ("aperti", "tutto"):
-        ws = new_sheet("Ticket Aperti")
-        q = Problem.query.filter(Problem.stato != "Chiuso")
-        if not is_admin:
-            q = q.filter_by(autore=username)
-        style_header(ws, ["ID", "Cinema", "Città", "Sala", "Descrizione", "Urgenza", "Stato", "Autore", "Data apertura"])
-        for p in q.order_by(Problem.data_ora.desc()).all():
-            ws.append([p.id, p.cinema, p.città, p.sala, p.tipo, p.urgenza, p.stato, p.autore, fmt(p.data_ora)])
-        autowidth(ws)
+    foglio = request.args.get("foglio", "tutto")  # aperti | chiusi | cinema | utenti | tutto
+    is_admin = session["role"] == "admin"
+    username = session["username"]
 
-    if foglio in ("chiusi", "tutto"):
-        ws = new_sheet("Archivio Chiusi")
-        q2 = Problem.query.filter_by(stato="Chiuso")
-        if not is_admin:
-            q2 = q2.filter_by(autore=username)
-        style_header(ws, ["ID", "Cinema", "Città", "Sala", "Descrizione", "Urgenza", "Autore", "Data apertura", "Chiuso da", "Chiuso il"])
-        for p in q2.order_by(Problem.data_ora.desc()).all():
-            ws.append([p.id, p.cinema, p.città, p.sala, p.tipo, p.urgenza, p.autore, fmt(p.data_ora), p.chiuso_da or "", fmt(p.chiuso_il)])
-        autowidth(ws)
+    # Export sincrono (fallback senza JS): usa comunque la cache su disco
+    cache_key = _export_cache_key(foglio, is_admin, username)
+    path = _export_cached_path(cache_key) or _build_export(foglio, is_admin, username, cache_key)
+    now = datetime.now().strftime("%Y%m%d_%H%M")
+    return send_file(
+        path,
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        as_attachment=True,
+        download_name=f"sigrafilm_{EXPORT_NAMES.get(foglio, foglio)}_{now}.xlsx",
+    )
 
-    if foglio in ("cinema", "tutto") and is_admin:
-        ws = new_sheet("Cinema")
-        style_header(ws, ["ID", "Nome", "Città", "Sale", "Telefono", "Indirizzo", "Lat", "Lng"])
-        for c in Cinema.query.order_by(Cinema.città.asc(), Cinema.nome.asc()).all():
-            ws.append([c.id, c.nome, c.città, c.num_sale, c.telefono or "", c.indirizzo or "", c.lat or "", c.lng or ""])
-        autowidth(ws)
+@app.route("/export/jobs", methods=["POST"])
+def export_job_create():
+    if "user_id" not in session:
+        return {"error": "login richiesto"}, 401
+    foglio = request.form.get("foglio", "tutto")
+    job = _submit_export_job(foglio, session["role"] == "admin", session["username"], session["user_id"])
+    return _job_json(job), 202 if job["status"] != "done" else 200
 
-    if foglio in ("utenti", "tutto") and is_admin:
-        ws = new_sheet("Utenti")
-        style_header(ws, ["ID", "Username", "Ruolo", "Email", "Telefono"])
-        for u in User.query.order_by(User.id.asc()).all():
-            ws.append([u.id, u.username, u.role, u.email or "", u.telefono or ""])
-        autowidth(ws)
-
-    buf = io.BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    now = datetime.now().strftime("%Y%m%d_%H%M")
-    nomi = {"aperti": "ticket_aperti", "chiusi": "archivio_chiusi",
-            "cinema": "cinema", "utenti": "utenti", "tutto": "completo"}
+@app.route("/export/jobs/<job_id>")
+def export_job_status(job_id):
+    if "user_id" not in session:
+        return {"error": "login richiesto"}, 401
+    job = _load_job(job_id)
+    if not job or job["user_id"] != session["user_id"]:
+        abort(404)
+    return _job_json(job)
+
+@app.route("/export/jobs/<job_id>/download")
+def export_job_download(job_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    job = _load_job(job_id)
+    if not job or job["user_id"] != session["user_id"] or job["status"] != "done":
+        abort(404)
+    if not os.path.exists(job["path"]):
+        abort(410)  # evitato dalla cache: il client rilancia l'export
+    os.utime(job["path"])
     return send_file(
-        buf,
+        job["path"],
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         as_attachment=True,
-        download_name=f"sigrafilm_{nomi.get(foglio, foglio)}_{now}.xlsx",
+        download_name=job["download_name"],
     )
 
 # --- IMPORT EXCEL ---
+app.config["IMPORT_CHUNK_SIZE"] = int(os.environ.get("IMPORT_CHUNK_SIZE", "1000"))
+# Processi per gli hash delle password nell'import utenti (0 = uno per core, al massimo 4:
+# scrypt usa ~32 MiB a hash e i piani piccoli hanno poca RAM)
+app.config["IMPORT_HASH_PROCESSES"] = int(os.environ.get("IMPORT_HASH_PROCESSES", "0")) or min(4, os.cpu_count() or 1)
+
+def _parse_dt(val):
+    if not val:
+        return None
+    if isinstance(val, datetime):
+        return val
+    try:
+        return datetime.strptime(str(val), "%d/%m/%Y %H:%M")
+    except Exception:
+        return None
+
+def _hash_passwords(passwords):
+    """Hash di molte password in parallelo su più processi (un core ciascuno).
+
+    Processi "spawn" avviati solo per questo blocco: non ereditano thread e
+    connessioni DB del worker, e importano solo werkzeug.
+    """
+    method = app.config["PASSWORD_HASH_METHOD"]
+    processes = min(app.config["IMPORT_HASH_PROCESSES"], len(passwords) // 4)
+    if processes <= 1:
+        return [generate_password_hash(p, method) for p in passwords]
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return list(pool.map(generate_password_hash, passwords, itertools.repeat(method),
+                             chunksize=max(1, len(passwords) // (processes * 4))))
+
+def _import_sheet(ws, sheet_name, model, parse_row, file_hash, chunk_size, dedup=None,
+                  prepare=None, after_insert=None):
+    """Importa un foglio a blocchi, senza caricarlo tutto in memoria.
+
+    Le righe sono lette in modo lazy; ogni blocco di chunk_size righe valide
+    viene inserito con un solo INSERT executemany e committato insieme al
+    checkpoint (file_hash, foglio), così un import interrotto riprende dalla
+    riga successiva all'ultimo blocco salvato. parse_row restituisce i valori
+    da inserire, None per una riga già presente, o solleva ValueError per una
+    riga scartata. dedup, se indicato, filtra ogni blocco prima dell'INSERT
+    (es. lookup indicizzato delle impronte già presenti); prepare completa le
+    righe rimaste (es. hash delle password) e after_insert scrive, nella stessa
+    transazione del blocco, le righe collegate (es. cinema assegnati agli utenti).
+    """
+    cp = ImportCheckpoint.query.filter_by(file_hash=file_hash, sheet=sheet_name).first()
+    if cp is None:
+        cp = ImportCheckpoint(file_hash=file_hash, sheet=sheet_name, last_row=1)
+        db.session.add(cp)
+    resumed_from = cp.last_row
+    result = {"sheet": sheet_name, "added": 0, "skipped": 0, "rejected": 0,
+              "resumed_from": resumed_from if resumed_from > 1 else None}
+    t0 = time.perf_counter()
+    chunk = []
+
+    def flush(row_idx):
+        rows = dedup(chunk) if dedup and chunk else chunk
+        result["skipped"] += len(chunk) - len(rows)
+        if rows:
+            if prepare:
+                rows = prepare(rows)
+            db.session.execute(db.insert(model), rows)
+            if after_insert:
+                after_insert(rows)
+            result["added"] += len(rows)
+        chunk.clear()
+        cp.last_row = row_idx
+        db.session.commit()
+
+    row_idx = resumed_from
+    for row_idx, row in enumerate(ws.iter_rows(min_row=resumed_from + 1, values_only=True),
+                                  start=resumed_from + 1):
+        if not row or not any(row):
+            continue
+        try:
+            values = parse_row(row)
+        except (ValueError, TypeError, IndexError):
+            result["rejected"] += 1
+            continue
+        if values is None:
+            result["skipped"] += 1
+            continue
+        chunk.append(values)
+        if len(chunk) >= chunk_size:
+            flush(row_idx)
+    flush(row_idx)
+
+    elapsed = time.perf_counter() - t0
+    processed = result["added"] + result["skipped"] + result["rejected"]
+    result["rows_per_s"] = processed / elapsed if elapsed > 0 else 0.0
+    return result
+
 @app.route("/import/excel", methods=["GET", "POST"])
 def import_excel():
     if "user_id" not in session:
@@ -782,116 +2434,497 @@ def import_excel():
         flash("Carica un file .xlsx valido.", "danger")
         return redirect(url_for("import_excel"))
 
+    # Copia su file temporaneo calcolando l'hash (chiave del checkpoint) senza tenerlo in RAM
+    upload = tempfile.TemporaryFile()
+    digest = hashlib.sha256()
+    for block in iter(lambda: f.stream.read(1024 * 1024), b""):
+        digest.update(block)
+        upload.write(block)
+    upload.seek(0)
+    file_hash = digest.hexdigest()
+
     try:
-        wb = openpyxl.load_workbook(f, read_only=True, data_only=True)
+        wb = openpyxl.load_workbook(upload, read_only=True, data_only=True)
     except Exception:
+        upload.close()
         flash("File non valido o corrotto.", "danger")
         return redirect(url_for("import_excel"))
 
-    added_problems = 0
-    skipped_problems = 0
-    added_cinemas = 0
-    skipped_cinemas = 0
+    chunk_size = app.config["IMPORT_CHUNK_SIZE"]
+    seen_fingerprints = set()  # duplicati interni al file
+    existing_cinema_nomi = set(cinema_catalog()["by_name"])
 
-    existing_problem_ids = {p.id for p in Problem.query.with_entities(Problem.id).all()}
-    existing_cinema_nomi = {c.nome for c in Cinema.query.with_entities(Cinema.nome).all()}
+    # Colonne dei fogli ticket come li scrive l'export: "Archivio Chiusi" non ha Stato
+    ticket_columns = {
+        "Ticket Aperti":   {"stato": 6, "autore": 7, "data_ora": 8},
+        "Archivio Chiusi": {"autore": 6, "data_ora": 7, "chiuso_da": 8, "chiuso_il": 9},
+    }
 
-    def _val(cell):
-        return cell.value if cell.value is not None else ""
+    def ticket_parser(sheet_name):
+        cols = ticket_columns[sheet_name]
 
-    def _parse_dt(val):
-        if not val:
-            return None
-        if isinstance(val, datetime):
-            return val
-        try:
-            return datetime.strptime(str(val), "%d/%m/%Y %H:%M")
-        except Exception:
-            return None
+        def cell(row, name):
+            i = cols.get(name)
+            return row[i] if i is not None and i < len(row) else None
 
-    # Fogli ticket: "Ticket Aperti" e "Archivio Chiusi"
-    for sheet_name in ["Ticket Aperti", "Archivio Chiusi"]:
-        ws = wb[sheet_name] if sheet_name in wb.sheetnames else None
-        if not ws:
-            continue
-        rows = list(ws.iter_rows(values_only=True))
-        if len(rows) < 2:
-            continue
-        for row in rows[1:]:  # salta header
-            if not any(row):
-                continue
-            try:
-                row_id   = int(row[0]) if row[0] else None
-                cinema   = str(row[1] or "").strip()
-                città    = str(row[2] or "").strip()
-                sala     = str(row[3] or "1").strip()
-                tipo     = str(row[4] or "").strip()
-                urgenza  = str(row[5] or "Non urgente").strip()
-                autore   = str(row[7] or "import").strip()
-                data_ora = _parse_dt(row[8]) if len(row) > 8 else None
-                stato    = str(row[6] or "Aperto").strip() if sheet_name == "Ticket Aperti" else "Chiuso"
-                chiuso_da = str(row[9] or "").strip() if len(row) > 9 else None
-                chiuso_il = _parse_dt(row[10]) if len(row) > 10 else None
-            except Exception:
-                continue
+        def parse(row):
+            cinema = str(row[1] or "").strip()
+            tipo   = str(row[4] or "").strip()
             if not cinema or not tipo:
-                continue
-            if row_id and row_id in existing_problem_ids:
-                skipped_problems += 1
-                continue
-            p = Problem(
-                cinema=cinema, città=città, sala=sala, tipo=tipo,
-                urgenza=urgenza, stato=stato, autore=autore,
-                data_ora=data_ora or datetime.utcnow(),
-                chiuso_da=chiuso_da or None,
-                chiuso_il=chiuso_il,
-            )
-            db.session.add(p)
-            if row_id:
-                existing_problem_ids.add(row_id)
-            added_problems += 1
-
-    # Foglio "Cinema"
-    if "Cinema" in wb.sheetnames:
-        ws = wb["Cinema"]
-        rows = list(ws.iter_rows(values_only=True))
-        for row in rows[1:]:
-            if not any(row):
-                continue
-            try:
-                nome     = str(row[1] or "").strip()
-                città    = str(row[2] or "").strip()
-                num_sale = int(row[3]) if row[3] else 1
-                telefono = str(row[4] or "").strip()
-                indirizzo= str(row[5] or "").strip()
-                lat      = float(row[6]) if row[6] else None
-                lng      = float(row[7]) if row[7] else None
-            except Exception:
-                continue
-            if not nome:
-                continue
-            if nome in existing_cinema_nomi:
-                skipped_cinemas += 1
-                continue
-            db.session.add(Cinema(nome=nome, città=città, num_sale=num_sale,
-                                  telefono=telefono, indirizzo=indirizzo, lat=lat, lng=lng))
-            existing_cinema_nomi.add(nome)
-            added_cinemas += 1
+                raise ValueError("cinema e descrizione obbligatori")
+            # Senza data di apertura l'impronta non sarebbe stabile tra un import e l'altro
+            data_ora = _parse_dt(cell(row, "data_ora"))
+            if data_ora is None:
+                raise ValueError("data di apertura mancante o non valida")
+            sala     = str(row[3] or "1").strip()
+            autore   = str(cell(row, "autore") or "import").strip()
+            fingerprint = problem_fingerprint(cinema, sala, tipo, autore, data_ora)
+            if fingerprint in seen_fingerprints:
+                return None
+            seen_fingerprints.add(fingerprint)
+            cinema_obj = cinemas_by_name.get(cinema)
+            return {
+                "cinema":   cinema,
+                "cinema_id": cinema_obj.id if cinema_obj else None,
+                "città":    str(row[2] or "").strip(),
+                "sala":     sala,
+                "tipo":     tipo,
+                "urgenza":  str(row[5] or "Non urgente").strip(),
+                "stato":    str(cell(row, "stato") or "Aperto").strip() if "stato" in cols else "Chiuso",
+                "autore":   autore,
+                "data_ora": data_ora,
+                "chiuso_da": str(cell(row, "chiuso_da") or "").strip() or None,
+                "chiuso_il": _parse_dt(cell(row, "chiuso_il")),
+                "fingerprint": fingerprint,
+            }
+        return parse
+
+    def lock_events(rows):
+        _lock_ticket_events()  # prima dell'INSERT del blocco, come nelle altre scritture
+        return rows
+
+    def cinemas_created(rows):
+        # Ticket già presenti che citano per nome i cinema appena inseriti, nello stesso commit
+        _link_cinema_tickets()
+
+    def problems_created(rows):
+        # Eventi "creato" nello stesso commit del blocco; l'impronta identifica le righe appena inserite
+        ids = dict(db.session.execute(
+            db.select(Problem.fingerprint, Problem.id).where(Problem.fingerprint.in_([r["fingerprint"] for r in rows]))
+        ).all())
+        _record_events([{"problem_id": ids[r["fingerprint"]], "tipo": "creato", "dati": _problem_snapshot(r)}
+                        for r in rows if r["fingerprint"] in ids])
+
+    def dedup_problems(rows):
+        # Lookup indicizzato per blocco: il costo dipende dal blocco, non dalla tabella
+        present = set(db.session.execute(
+            db.select(Problem.fingerprint).where(Problem.fingerprint.in_([r["fingerprint"] for r in rows]))
+        ).scalars())
+        return [r for r in rows if r["fingerprint"] not in present]
+
+    def parse_cinema(row):
+        nome = str(row[1] or "").strip()
+        if not nome:
+            raise ValueError("nome obbligatorio")
+        if nome in existing_cinema_nomi:
+            return None
+        existing_cinema_nomi.add(nome)
+        return {
+            "nome":      nome,
+            "città":     str(row[2] or "").strip(),
+            "num_sale":  int(row[3]) if row[3] else 1,
+            "telefono":  str(row[4] or "").strip(),
+            "indirizzo": str(row[5] or "").strip(),
+            "lat":       float(row[6]) if row[6] else None,
+            "lng":       float(row[7]) if row[7] else None,
+        }
+
+    existing_usernames = set(db.session.execute(db.select(User.username)).scalars())
+    user_cinemas = {}  # username -> cinema_id assegnati, scritti dopo l'INSERT degli utenti
+
+    def parse_user(row):
+        # ID, Username, Ruolo, Email, Telefono, Cinema (separati da ";"), Password
+        username = str(row[1] or "").strip()
+        if not username:
+            raise ValueError("username obbligatorio")
+        if username in existing_usernames:
+            return None
+        role = str(row[2] or "user").strip().lower()
+        if role not in ("user", "admin"):
+            raise ValueError("ruolo non valido")
+        password = str(row[6] or "").strip() if len(row) > 6 else ""
+        if len(password) < 8:
+            raise ValueError("password di almeno 8 caratteri")
+        cinema_ids = []
+        for nome in re.split(r"[;\n]", str(row[5] or "") if len(row) > 5 else ""):
+            if nome.strip():
+                cinema = cinemas_by_name.get(nome.strip())
+                if cinema is None:
+                    raise ValueError("cinema sconosciuto")
+                cinema_ids.append(cinema.id)
+        existing_usernames.add(username)
+        user_cinemas[username] = cinema_ids
+        return {
+            "username": username,
+            "role":     role,
+            "email":    str(row[3] or "").strip(),
+            "telefono": str(row[4] or "").strip(),
+            "password_plain": password,
+        }
+
+    def prepare_users(rows):
+        hashes = _hash_passwords([r["password_plain"] for r in rows])
+        return [dict(r, password_hash=h) for r, h in zip(rows, hashes)]
+
+    def assign_user_cinemas(rows):
+        ids = db.session.execute(
+            db.select(User.username, User.id).where(User.username.in_([r["username"] for r in rows]))
+        ).all()
+        assignments = [{"user_id": uid, "cinema_id": cid}
+                       for username, uid in ids for cid in dict.fromkeys(user_cinemas.pop(username, []))]
+        if assignments:
+            db.session.execute(db.insert(UserCinema), assignments)
+
+    results = []
+    try:
+        # Foglio "Cinema" per primo, così ticket e utenti trovano il cinema_id
+        if "Cinema" in wb.sheetnames:
+            results.append(_import_sheet(wb["Cinema"], "Cinema", Cinema,
+                                         parse_cinema, file_hash, chunk_size,
+                                         prepare=lock_events, after_insert=cinemas_created))
+            if results[-1]["added"]:
+                _bump_cinema_catalog()
+        cinemas_by_name = cinema_catalog()["by_name"]
+        if "Utenti" in wb.sheetnames:
+            results.append(_import_sheet(wb["Utenti"], "Utenti", User, parse_user, file_hash, chunk_size,
+                                         prepare=prepare_users, after_insert=assign_user_cinemas))
+        # Fogli ticket: "Ticket Aperti" e "Archivio Chiusi"
+        for sheet_name in ["Ticket Aperti", "Archivio Chiusi"]:
+            if sheet_name in wb.sheetnames:
+                results.append(_import_sheet(wb[sheet_name], sheet_name, Problem,
+                                             ticket_parser(sheet_name), file_hash, chunk_size,
+                                             dedup=dedup_problems, prepare=lock_events,
+                                             after_insert=problems_created))
+    except Exception:
+        db.session.rollback()
+        flash("Import interrotto: ricarica lo stesso file per riprendere dall'ultimo blocco salvato.", "danger")
+        return redirect(url_for("import_excel"))
+    finally:
+        wb.close()
+        upload.close()
 
+    # Import completato: i checkpoint di questo file non servono più
+    ImportCheckpoint.query.filter_by(file_hash=file_hash).delete()
     db.session.commit()
 
-    parts = []
-    if added_problems:   parts.append(f"{added_problems} ticket aggiunti")
-    if skipped_problems: parts.append(f"{skipped_problems} ticket già presenti (saltati)")
-    if added_cinemas:    parts.append(f"{added_cinemas} cinema aggiunti")
-    if skipped_cinemas:  parts.append(f"{skipped_cinemas} cinema già presenti (saltati)")
-    if not parts:
+    if not any(r["added"] for r in results):
         flash("Nessuna nuova riga trovata — tutto già presente.", "info")
-    else:
-        flash(" · ".join(parts) + ".", "success")
+    for r in results:
+        parts = [f"{r['added']} aggiunti"]
+        if r["skipped"]:  parts.append(f"{r['skipped']} già presenti (saltati)")
+        if r["rejected"]: parts.append(f"{r['rejected']} scartati")
+        if r["resumed_from"]: parts.append(f"ripreso dalla riga {r['resumed_from'] + 1}")
+        parts.append(f"{r['rows_per_s']:.0f} righe/s")
+        flash(f"{r['sheet']}: " + " · ".join(parts) + ".", "success" if r["added"] else "info")
 
     return redirect(url_for("import_excel"))
 
+# --- VERIFICA INDICI (flask check-indexes) ---
+@app.cli.command("check-indexes")
+def check_indexes():
+    """Esegue EXPLAIN sulle query di dashboard e archivio e verifica che usino gli indici."""
+    postgres = db.engine.dialect.name == "postgresql"
+    checks = [
+        ("dashboard admin", Problem.query.filter(Problem.stato != "Chiuso"),
+         "ix_problems_open_data"),
+        ("dashboard utente", Problem.query.filter(Problem.stato != "Chiuso").filter_by(autore="admin"),
+         "ix_problems_open_autore_data"),
+        ("archivio admin", Problem.query.filter_by(stato="Chiuso"),
+         "ix_problems_stato_data"),
+        ("archivio utente", Problem.query.filter_by(stato="Chiuso", autore="admin"),
+         "ix_problems_stato_autore_data"),
+        ("chat ticket", Comment.query.filter_by(problem_id=1).order_by(Comment.data_ora.asc()),
+         "ix_comments_problem_data"),
+        ("cinema per nome", Cinema.query.filter_by(nome="Cinema Firenze"),
+         "ix_cinemas_nome"),
+        ("ricerca full-text", Problem.query.filter(Problem.id.in_(_search_matches(["proiettore"])[0])),
+         "ix_problems_search" if postgres else "problems_fts"),
+    ]
+    failed = 0
+    with db.engine.connect() as conn:
+        if postgres:
+            # Su tabelle piccole il planner preferisce il seq scan: lo escludiamo
+            conn.execute(db.text("SET enable_seqscan = off"))
+        for label, q, index_name in checks:
+            if q.column_descriptions[0]["entity"] is Problem:
+                q = q.order_by(Problem.data_ora.desc(), Problem.id.desc()).limit(51)
+            sql = str(q.statement.compile(conn, compile_kwargs={"literal_binds": True}))
+            prefix = "EXPLAIN " if postgres else "EXPLAIN QUERY PLAN "
+            rows = conn.exec_driver_sql(prefix + sql).all()
+            plan = " | ".join(str(r[-1]) for r in rows)
+            ok = index_name in plan
+            failed += not ok
+            print(f"{'✅' if ok else '❌'} {label}: {plan}")
+    if failed:
+        raise SystemExit(1)
+
+# --- METRICHE (Prometheus + Server-Timing) ---
+# Per ogni richiesta: durata totale, numero e tempo delle query SQL, tempo di render dei
+# template. Gli aggregati sono per processo (ogni worker gunicorn ha i suoi) e si leggono
+# da /metrics: admin loggato oppure header "Authorization: Bearer $METRICS_TOKEN".
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN", "")
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = {}  # (endpoint, metodo) -> {"buckets", "sum", "count", "queries", "db_seconds", "status"}
+_metrics_lock = threading.Lock()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _sql_timer_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _sql_timer_stop(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["_query_start"].pop()
+    if has_request_context() and "_req_start" in g:
+        g._sql_count += 1
+        g._sql_seconds += elapsed
+        _track_statement(statement, elapsed)
+    if elapsed * 1000 >= app.config["SLOW_QUERY_MS"] > 0 and not conn.info.get("_explaining"):
+        _log_slow_query(conn, cursor, statement, parameters, executemany, elapsed)
+
+@event.listens_for(Engine, "handle_error")
+def _sql_timer_error(context):
+    starts = context.connection.info.get("_query_start") if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+@before_render_template.connect_via(app)
+def _render_timer_start(sender, template, context, **extra):
+    if has_request_context():
+        g._render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _render_timer_stop(sender, template, context, **extra):
+    if has_request_context() and "_render_start" in g:
+        g._render_seconds = g.get("_render_seconds", 0.0) + time.perf_counter() - g.pop("_render_start")
+
+@app.before_request
+def _metrics_start():
+    g._req_start = time.perf_counter()
+    g._sql_count = 0
+    g._sql_seconds = 0.0
+
+@app.after_request
+def _metrics_record(response):
+    if "_req_start" not in g:
+        return response
+    total = time.perf_counter() - g._req_start
+    render = g.get("_render_seconds", 0.0)
+    response.headers["Server-Timing"] = (
+        f'db;dur={g._sql_seconds * 1000:.1f};desc="SQL ({g._sql_count} query)", '
+        f'render;dur={render * 1000:.1f};desc="Template", '
+        f'app;dur={total * 1000:.1f};desc="Totale"'
+    )
+    _check_n_plus_one()
+    key = (request.endpoint or "sconosciuto", request.method)
+    with _metrics_lock:
+        m = _metrics.get(key)
+        if m is None:
+            m = _metrics[key] = {"buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0,
+                                 "queries": 0, "db_seconds": 0.0, "render_seconds": 0.0, "status": {}}
+        for i, le in enumerate(METRICS_BUCKETS):
+            if total <= le:
+                m["buckets"][i] += 1
+        m["sum"] += total
+        m["count"] += 1
+        m["queries"] += g._sql_count
+        m["db_seconds"] += g._sql_seconds
+        m["render_seconds"] += render
+        status = f"{response.status_code // 100}xx"
+        m["status"][status] = m["status"].get(status, 0) + 1
+    return response
+
+def _prometheus_text():
+    """Aggregati di questo processo nel formato testuale di Prometheus."""
+    with _metrics_lock:
+        snapshot = {k: dict(v, buckets=list(v["buckets"]), status=dict(v["status"])) for k, v in _metrics.items()}
+    lines = [
+        "# HELP sigra_request_duration_seconds Durata delle richieste HTTP per endpoint.",
+        "# TYPE sigra_request_duration_seconds histogram",
+    ]
+    for (endpoint, method), m in sorted(snapshot.items()):
+        labels = f'endpoint="{endpoint}",method="{method}"'
+        for le, n in zip(METRICS_BUCKETS, m["buckets"]):
+            lines.append(f'sigra_request_duration_seconds_bucket{{{labels},le="{le}"}} {n}')
+        lines.append(f'sigra_request_duration_seconds_bucket{{{labels},le="+Inf"}} {m["count"]}')
+        lines.append(f"sigra_request_duration_seconds_sum{{{labels}}} {m['sum']:.6f}")
+        lines.append(f"sigra_request_duration_seconds_count{{{labels}}} {m['count']}")
+    for name, field, help_text in (
+        ("sigra_db_queries_total", "queries", "Query SQL eseguite dalle richieste per endpoint."),
+        ("sigra_db_seconds_total", "db_seconds", "Tempo speso nelle query SQL per endpoint."),
+        ("sigra_render_seconds_total", "render_seconds", "Tempo speso nel render dei template per endpoint."),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for (endpoint, method), m in sorted(snapshot.items()):
+            lines.append(f'{name}{{endpoint="{endpoint}",method="{method}"}} {m[field]}')
+    lines += ["# HELP sigra_requests_total Richieste per endpoint e classe di stato.",
+              "# TYPE sigra_requests_total counter"]
+    for (endpoint, method), m in sorted(snapshot.items()):
+        for status, n in sorted(m["status"].items()):
+            lines.append(f'sigra_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+@app.route("/metrics")
+def metrics():
+    if not _bearer_authorized(app.config["METRICS_TOKEN"]):
+        return "Accesso negato", 403
+    return Response(_prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+# --- QUERY LENTE E N+1 ---
+# Alimentati dagli stessi eventi SQL delle metriche. Una query più lenta di SLOW_QUERY_MS
+# finisce nel log (con il piano, se SLOW_QUERY_EXPLAIN=1); la stessa istruzione ripetuta
+# più di N_PLUS_ONE_THRESHOLD volte in una richiesta viene segnalata come N+1.
+# Entrambi gli elenchi sono in memoria nel processo, con le ultime SLOW_QUERY_LOG_SIZE voci.
+app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", "200"))
+app.config["SLOW_QUERY_EXPLAIN"] = os.environ.get("SLOW_QUERY_EXPLAIN", "0") == "1"
+app.config["N_PLUS_ONE_THRESHOLD"] = int(os.environ.get("N_PLUS_ONE_THRESHOLD", "10"))
+app.config["SLOW_QUERY_LOG_SIZE"] = int(os.environ.get("SLOW_QUERY_LOG_SIZE", "200"))
+
+_slow_queries = deque(maxlen=app.config["SLOW_QUERY_LOG_SIZE"])
+_n_plus_one = deque(maxlen=app.config["SLOW_QUERY_LOG_SIZE"])
+_slow_log_lock = threading.Lock()
+
+# Liste di segnaposto (IN (?, ?, ...)) e letterali numerici: stessa forma, stessa istruzione
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))+\s*\)")
+_NUMBER = re.compile(r"\b\d+\b")
+
+@functools.lru_cache(maxsize=2048)
+def _statement_template(statement):
+    return _NUMBER.sub("N", _PLACEHOLDER_LIST.sub("(…)", " ".join(statement.split())))
+
+def _params_shape(parameters, executemany):
+    """Forma dei parametri senza i valori: tipi (e numero di righe per executemany)."""
+    def shape(p):
+        if isinstance(p, dict):
+            return {k: type(v).__name__ for k, v in p.items()}
+        if isinstance(p, (list, tuple)):
+            return [type(v).__name__ for v in p]
+        return type(p).__name__
+    if executemany:
+        rows = list(parameters or [])
+        return {"righe": len(rows), "riga": shape(rows[0]) if rows else None}
+    return shape(parameters)
+
+def _request_route():
+    if has_request_context():
+        return {"endpoint": request.endpoint or "sconosciuto", "method": request.method, "path": request.path}
+    return {"endpoint": None, "method": None, "path": None}  # CLI, job in background
+
+def _track_statement(statement, elapsed):
+    stats = g.get("_sql_templates")
+    if stats is None:
+        stats = g._sql_templates = {}
+    entry = stats.setdefault(_statement_template(statement), [0, 0.0])
+    entry[0] += 1
+    entry[1] += elapsed
+
+def _explain(conn, cursor, statement, parameters):
+    """Piano della query sulla stessa connessione DBAPI (niente eventi SQLAlchemy, stessa transazione).
+
+    Su PostgreSQL l'EXPLAIN gira dentro un SAVEPOINT: se fallisce si torna al savepoint e la
+    transazione della richiesta resta utilizzabile invece di finire in stato "aborted".
+    """
+    postgres = conn.dialect.name == "postgresql"
+    explain_cur = cursor.connection.cursor()
+    try:
+        if postgres:
+            explain_cur.execute("SAVEPOINT slow_query_explain")
+        try:
+            explain_cur.execute(("EXPLAIN " if postgres else "EXPLAIN QUERY PLAN ") + statement, parameters)
+            plan = "\n".join(str(r[-1]) for r in explain_cur.fetchall())
+        except Exception as e:
+            if postgres:
+                explain_cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            plan = f"EXPLAIN non riuscito: {e}"
+        if postgres:
+            explain_cur.execute("RELEASE SAVEPOINT slow_query_explain")
+        return plan
+    except Exception as e:
+        return f"EXPLAIN non riuscito: {e}"
+    finally:
+        explain_cur.close()
+
+def _log_slow_query(conn, cursor, statement, parameters, executemany, elapsed):
+    plan = None
+    if app.config["SLOW_QUERY_EXPLAIN"] and not executemany and \
+            statement.lstrip()[:6].upper() in ("SELECT", "WITH"):
+        conn.info["_explaining"] = True
+        try:
+            plan = _explain(conn, cursor, statement, parameters)
+        finally:
+            conn.info["_explaining"] = False
+    entry = {
+        "at": datetime.utcnow().isoformat(timespec="seconds"),
+        "duration_ms": round(elapsed * 1000, 1),
+        "statement": statement[:4000],
+        "params": _params_shape(parameters, executemany),
+        "plan": plan,
+        **_request_route(),
+    }
+    with _slow_log_lock:
+        _slow_queries.append(entry)
+    print(f"🐢 Query lenta {entry['duration_ms']} ms [{entry['method']} {entry['path']}]: "
+          f"{' '.join(statement.split())[:200]}")
+
+def _check_n_plus_one():
+    threshold = app.config["N_PLUS_ONE_THRESHOLD"]
+    found = [(tpl, n, secs) for tpl, (n, secs) in g.get("_sql_templates", {}).items() if n > threshold]
+    if not found:
+        return
+    route = _request_route()
+    with _slow_log_lock:
+        for tpl, n, secs in found:
+            _n_plus_one.append({"at": datetime.utcnow().isoformat(timespec="seconds"), "count": n,
+                                "total_ms": round(secs * 1000, 1), "statement": tpl[:4000], **route})
+    for tpl, n, _ in found:
+        print(f"🔁 Possibile N+1 [{route['method']} {route['path']}]: {n}× {tpl[:200]}")
+
+def _slow_query_report():
+    with _slow_log_lock:
+        slow, n1 = list(_slow_queries), list(_n_plus_one)
+    return {
+        "config": {k: app.config[k] for k in ("SLOW_QUERY_MS", "SLOW_QUERY_EXPLAIN",
+                                              "N_PLUS_ONE_THRESHOLD", "SLOW_QUERY_LOG_SIZE")},
+        "pid": os.getpid(),
+        "slow_queries": sorted(slow, key=lambda e: e["duration_ms"], reverse=True),
+        "n_plus_one": sorted(n1, key=lambda e: e["count"], reverse=True),
+    }
+
+@app.route("/admin/slow-queries")
+def admin_slow_queries():
+    if session.get("role") != "admin":
+        return "Accesso negato", 403
+    return render_template("slow_queries.html", report=_slow_query_report())
+
+@app.route("/admin/slow-queries.json")
+def admin_slow_queries_json():
+    if session.get("role") != "admin":
+        return {"error": "Accesso negato"}, 403
+    resp = app.json.response(_slow_query_report())
+    if request.args.get("download"):
+        resp.headers["Content-Disposition"] = f"attachment; filename=slow_queries_{os.getpid()}.json"
+    return resp
+
+@app.route("/admin/slow-queries/clear", methods=["POST"])
+def admin_slow_queries_clear():
+    if session.get("role") != "admin":
+        return "Accesso negato", 403
+    with _slow_log_lock:
+        _slow_queries.clear()
+        _n_plus_one.clear()
+    flash("Log delle query lente svuotato.", "success")
+    return redirect(url_for("admin_slow_queries"))
+
 # --- GESTIONE ERRORI ---
 @app.teardown_appcontext
 def _rollback_on_error(exc):
@@ -907,5 +2940,6 @@ def _internal_error(e):
 # --- MAIN ---
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
+        _upgrade_db()
+        _seed_db()
     app.run(host="0.0.0.0", port=5000, debug=True)
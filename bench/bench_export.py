@@ -0,0 +1,114 @@
+"""Benchmark dell'export Excel: tempo e picco di memoria con N ticket.
+
+Uso:
+    python bench/bench_export.py                 # 100k ticket, foglio "tutto"
+    python bench/bench_export.py --tickets 20000 --foglio chiusi
+
+Crea un DB SQLite temporaneo, lo riempie con insert bulk e scarica
+/export/excel tramite il test client di Flask misurando il picco di
+memoria Python (tracemalloc). Con --legacy misura anche il vecchio
+percorso (Workbook in memoria + autowidth + BytesIO) per confronto.
+I tempi includono l'overhead di tracemalloc: contano i rapporti, non i valori assoluti.
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+_tmpdir = tempfile.mkdtemp(prefix="sigra_bench_")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_tmpdir, "bench.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import openpyxl  # noqa: E402
+from app import app, db, Problem, _upgrade_db, _seed_db, _export_sheets  # noqa: E402
+
+URGENZE = ["Non urgente", "Urgente", "Critico"]
+DESCRIZIONI = ["Proiettore non si accende", "Audio assente in sala", "Lampada da sostituire",
+               "Server DCP in errore", "Aria condizionata guasta", "Schermo macchiato"]
+
+
+def fill(n):
+    start = datetime(2020, 1, 1)
+    rows = []
+    for i in range(n):
+        chiuso = random.random() < 0.8
+        rows.append({
+            "cinema": f"Cinema {i % 40}", "città": "Firenze", "sala": str(i % 6 + 1),
+            "tipo": random.choice(DESCRIZIONI) + f" #{i}", "urgenza": random.choice(URGENZE),
+            "stato": "Chiuso" if chiuso else random.choice(["Aperto", "In corso"]),
+            "autore": f"user{i % 30}", "data_ora": start + timedelta(minutes=17 * i),
+            "chiuso_da": "admin" if chiuso else None,
+            "chiuso_il": start + timedelta(minutes=17 * i + 600) if chiuso else None,
+            "comment_count": 0,
+        })
+        if len(rows) == 5000:
+            db.session.execute(db.insert(Problem), rows)
+            rows = []
+    if rows:
+        db.session.execute(db.insert(Problem), rows)
+    db.session.commit()
+
+
+def legacy_export(foglio):
+    """Vecchio percorso: Workbook normale, autowidth su tutte le celle, BytesIO."""
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    for title, headers, rows in _export_sheets(foglio, True, "admin"):
+        ws = wb.create_sheet(title)
+        ws.append(headers)
+        for row in list(rows):
+            ws.append(row)
+        for col in ws.columns:
+            max_len = max((len(str(c.value)) if c.value else 0) for c in col)
+            ws.column_dimensions[col[0].column_letter].width = min(max_len + 4, 60)
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getbuffer().nbytes
+
+
+def measure(label, fn):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    size = fn()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<10} {elapsed:8.2f} s   picco {peak / 1024 / 1024:8.1f} MiB   file {size / 1024 / 1024:6.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=100_000)
+    parser.add_argument("--foglio", default="tutto")
+    parser.add_argument("--legacy", action="store_true", help="misura anche il vecchio export in memoria")
+    args = parser.parse_args()
+
+    with app.app_context():
+        _upgrade_db()
+        _seed_db()
+        t0 = time.perf_counter()
+        fill(args.tickets)
+        print(f"{args.tickets} ticket generati in {time.perf_counter() - t0:.1f} s")
+
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s.update(user_id=1, role="admin", username="admin")
+
+    def streaming():
+        r = client.get(f"/export/excel?foglio={args.foglio}")
+        assert r.status_code == 200, r.status_code
+        return sum(len(chunk) for chunk in r.response)
+
+    measure("streaming", streaming)
+    if args.legacy:
+        with app.app_context():
+            measure("legacy", lambda: legacy_export(args.foglio))
+
+
+if __name__ == "__main__":
+    main()
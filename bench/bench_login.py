@@ -0,0 +1,125 @@
+"""Benchmark dei login sotto carico: throughput dei login e latenza delle dashboard di chi è già dentro.
+
+Uso:
+    python bench/bench_login.py                                  # hash nel thread vs pool, 20 s ciascuno
+    python bench/bench_login.py --logins 16 --readers 8 --duration 30
+    WEB_CONCURRENCY=4 GUNICORN_THREADS=8 python bench/bench_login.py --scenarios pool
+
+Per ogni scenario avvia gunicorn (gunicorn.conf.py) su una copia del dataset di bench/gen_data.py
+e fa girare insieme, per --duration secondi:
+- --logins thread che ripetono login corretti da zero (nuova sessione ogni volta), come al cambio turno
+- --readers operatori già loggati che aprono la dashboard senza pause
+Scenari: "inline" calcola l'hash nel thread della richiesta (PASSWORD_HASH_WORKERS=0, il
+comportamento precedente), "pool" usa il pool limitato con i valori di default o quelli
+dell'ambiente. Il rate limit dei tentativi falliti non entra in gioco: i login sono tutti corretti.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from load_test import ROOT, Operator, free_port, load_operators, percentile, wait_ready
+
+SCENARIOS = {
+    "inline": {"PASSWORD_HASH_WORKERS": "0"},
+    "pool": {},
+}
+
+
+def run_scenario(name, db_path, args, workdir):
+    database_url = "sqlite:///" + db_path
+    operators = load_operators(database_url, args.logins + args.readers, args.seed)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, DATABASE_URL=database_url, EXPORT_CACHE_DIR=os.path.join(workdir, "export"),
+               SLOW_QUERY_MS="0", **SCENARIOS[name])
+    cmd = ["gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"), "app:app", "--bind", f"127.0.0.1:{port}"]
+    log = open(os.path.join(workdir, f"gunicorn_{name}.log"), "w")
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    samples = {}
+    lock = threading.Lock()
+
+    def record(route, elapsed, status):
+        with lock:
+            samples.setdefault(route, []).append((elapsed, status))
+
+    try:
+        wait_ready(base_url, proc)
+        readers = [Operator(base_url, u, [], record) for u, _ in operators[args.logins:]]
+        for r in readers:
+            r.login()
+        samples.clear()  # misura solo la fase di carico
+        stop_at = time.monotonic() + args.duration
+
+        def login_loop(username):
+            while time.monotonic() < stop_at:
+                Operator(base_url, username, [], record).login()
+
+        def reader_loop(client):
+            while time.monotonic() < stop_at:
+                client.request("GET /dashboard", "GET", "/dashboard")
+
+        threads = [threading.Thread(target=login_loop, args=(u,)) for u, _ in operators[:args.logins]]
+        threads += [threading.Thread(target=reader_loop, args=(r,)) for r in readers]
+        t0 = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.monotonic() - t0
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+
+    logins = samples.get("login", [])
+    ok = sorted(e * 1000 for e, status in logins if status == 302)
+    dash = sorted(e * 1000 for e, status in samples.get("GET /dashboard", []) if status == 200)
+    return {
+        "login_s": len(ok) / wall,
+        "login_503": sum(1 for _, status in logins if status == 503),
+        "login_err": sum(1 for _, status in logins if status not in (302, 503)),
+        "login_p50": percentile(ok, 50), "login_p99": percentile(ok, 99),
+        "dash_s": len(dash) / wall, "dash_p50": percentile(dash, 50), "dash_p99": percentile(dash, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default="inline,pool", help="scenari separati da virgola: inline,pool")
+    parser.add_argument("--logins", type=int, default=12, help="thread che ripetono il login")
+    parser.add_argument("--readers", type=int, default=8, help="operatori loggati che aprono la dashboard")
+    parser.add_argument("--duration", type=float, default=20, help="secondi per scenario")
+    parser.add_argument("--tickets", default="10k", help="dimensione del dataset (vedi gen_data.py)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "sigra_bench_data"))
+    args = parser.parse_args()
+
+    source = os.path.join(args.data_dir, f"sigra_{args.tickets}_s{args.seed}.db")
+    if not os.path.exists(source):
+        os.makedirs(args.data_dir, exist_ok=True)
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(__file__), "gen_data.py"),
+                        "--tickets", args.tickets, "--db", source, "--seed", str(args.seed)], check=True)
+
+    print(f"{'scenario':<8} {'login/s':>8} {'503':>5} {'errori':>6} {'login p50':>10} {'login p99':>10} "
+          f"{'dash/s':>7} {'dash p50':>9} {'dash p99':>9}")
+    for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        workdir = tempfile.mkdtemp(prefix="sigra_login_")
+        db_path = os.path.join(workdir, "login.db")
+        shutil.copyfile(source, db_path)
+        r = run_scenario(name, db_path, args, workdir)
+        print(f"{name:<8} {r['login_s']:>8.1f} {r['login_503']:>5} {r['login_err']:>6} {r['login_p50']:>8.0f}ms "
+              f"{r['login_p99']:>8.0f}ms {r['dash_s']:>7.1f} {r['dash_p50']:>7.0f}ms {r['dash_p99']:>7.0f}ms")
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
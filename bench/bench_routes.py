@@ -0,0 +1,220 @@
+"""Benchmark delle route principali su dati sintetici: latenza, numero di query e picco di memoria.
+
+Uso:
+    python bench/bench_routes.py --sizes 10k,100k
+    python bench/bench_routes.py --sizes 10k --save bench/baseline.json
+    python bench/bench_routes.py --sizes 10k --compare bench/baseline.json
+
+Per ogni dimensione genera (una volta, poi lo riusa) un DB SQLite con bench/gen_data.py
+in --data-dir, e misura ogni route in un processo separato tramite il test client di Flask:
+- latenza: mediana e p95 su --reps richieste, dopo una richiesta di riscaldamento
+- query: istruzioni SQL eseguite da una richiesta
+- memoria: picco Python (tracemalloc) in una richiesta in più, fuori dalle misure di latenza
+L'export è misurato a cache vuota; l'import carica 1000 ticket nuovi a ogni richiesta e li
+cancella subito dopo, così il DB resta uguale tra un giro e l'altro.
+Con --compare esce con codice 1 se una route è più lenta della baseline oltre --tolerance
+o esegue più query.
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORT_ROWS = 1000
+
+
+def run_worker(db_path, reps):
+    """Eseguito nel processo figlio: misura tutte le route sul DB indicato e stampa JSON."""
+    cache_dir = tempfile.mkdtemp(prefix="sigra_bench_export_")
+    os.environ["DATABASE_URL"] = "sqlite:///" + db_path
+    os.environ["EXPORT_CACHE_DIR"] = cache_dir
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    import openpyxl
+    from sqlalchemy import event
+    from app import app, db, User, Problem
+
+    queries = [0]
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", lambda *a: queries.__setitem__(0, queries[0] + 1))
+        admin = db.session.execute(db.select(User).filter_by(username="admin")).scalar_one()
+        # L'utente con più ticket: il caso peggiore per la dashboard con scope utente
+        top_autore = db.session.execute(
+            db.select(Problem.autore).where(Problem.autore != "admin")
+            .group_by(Problem.autore).order_by(db.func.count().desc()).limit(1)
+        ).scalar()
+        user = db.session.execute(db.select(User).filter_by(username=top_autore)).scalar_one()
+        sessions = {"admin": (admin.id, "admin", "admin"), "utente": (user.id, user.role, user.username)}
+
+    clients = {}
+    for name, (uid, role, username) in sessions.items():
+        clients[name] = app.test_client()
+        with clients[name].session_transaction() as s:
+            s.update(user_id=uid, role=role, username=username)
+
+    rep_counter = [0]
+
+    def import_workbook():
+        rep_counter[0] += 1
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.title = "Ticket Aperti"
+        ws.append(["ID", "Cinema", "Città", "Sala", "Descrizione", "Urgenza", "Stato", "Autore", "Data"])
+        for i in range(IMPORT_ROWS):
+            ws.append([None, "Cinema Firenze", "Firenze", "1", f"Import bench {rep_counter[0]}-{i}",
+                       "Urgente", "Aperto", "bench-import", "01/01/2026 10:00"])
+        buf = io.BytesIO()
+        wb.save(buf)
+        return buf.getvalue()
+
+    def clear_export_cache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cleanup_import():
+        with app.app_context():
+            db.session.execute(db.delete(Problem).where(Problem.autore == "bench-import"))
+            db.session.commit()
+
+    # (nome, client, metodo, url, prima di ogni richiesta → kwargs, dopo ogni richiesta)
+    routes = [
+        ("dashboard admin", "admin", "get", "/dashboard", None, None),
+        ("dashboard utente", "utente", "get", "/dashboard", None, None),
+        ("archivio admin", "admin", "get", "/closed", None, None),
+        ("archivio utente", "utente", "get", "/closed", None, None),
+        ("cinema admin", "admin", "get", "/admin/cinemas", None, None),
+        ("export aperti", "admin", "get", "/export/excel?foglio=aperti",
+         lambda: clear_export_cache() or {}, None),
+        (f"import {IMPORT_ROWS} righe", "admin", "post", "/import/excel",
+         lambda: {"data": {"file": (io.BytesIO(import_workbook()), "bench.xlsx")},
+                  "content_type": "multipart/form-data"},
+         cleanup_import),
+    ]
+
+    results = {}
+    for name, client_name, method, url, before, after in routes:
+        client = clients[client_name]
+
+        def request_once():
+            kwargs = before() if before else {}
+            queries[0] = 0
+            t0 = time.perf_counter()
+            r = getattr(client, method)(url, **kwargs)
+            r.get_data()  # consuma anche le risposte in streaming
+            elapsed = time.perf_counter() - t0
+            n = queries[0]
+            if after:
+                after()
+            return r.status_code, elapsed, n
+
+        request_once()  # riscaldamento: cache catalogo, piani di query, import dei moduli
+        timings, counts, status = [], [], None
+        for _ in range(reps):
+            status, elapsed, n = request_once()
+            timings.append(elapsed * 1000)
+            counts.append(n)
+        tracemalloc.start()
+        request_once()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        timings.sort()
+        results[name] = {
+            "status": status,
+            "p50_ms": round(statistics.median(timings), 2),
+            "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+            "queries": max(counts),
+            "peak_mib": round(peak / 1024 / 1024, 2),
+        }
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    print(json.dumps(results))
+
+
+def dataset(size, data_dir, seed):
+    path = os.path.join(data_dir, f"sigra_{size}_s{seed}.db")
+    if not os.path.exists(path):
+        print(f"Genero il dataset {size} in {path}…")
+        subprocess.run([sys.executable, os.path.join(HERE, "gen_data.py"),
+                        "--tickets", size, "--db", path, "--seed", str(seed)], check=True)
+    return path
+
+
+def print_table(size, results, baseline=None):
+    print(f"\n== {size} ==")
+    print(f"{'route':<22} {'stato':>5} {'p50 ms':>9} {'p95 ms':>9} {'query':>6} {'picco MiB':>10}")
+    for name, r in results.items():
+        line = (f"{name:<22} {r['status']:>5} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} "
+                f"{r['queries']:>6} {r['peak_mib']:>10.1f}")
+        base = (baseline or {}).get(name)
+        if base:
+            line += f"   vs baseline: p50 {r['p50_ms'] / base['p50_ms']:.2f}x, query {r['queries'] - base['queries']:+d}"
+        print(line)
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for size, routes in results.items():
+        for name, r in routes.items():
+            base = baseline.get(size, {}).get(name)
+            if not base:
+                continue
+            if r["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+                found.append(f"{size} {name}: p50 {base['p50_ms']} → {r['p50_ms']} ms")
+            if r["queries"] > base["queries"]:
+                found.append(f"{size} {name}: query {base['queries']} → {r['queries']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10k", help="dimensioni separate da virgola: 10k,100k,1m")
+    parser.add_argument("--reps", type=int, default=10, help="richieste misurate per route")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "sigra_bench_data"))
+    parser.add_argument("--save", metavar="FILE", help="salva i risultati come baseline")
+    parser.add_argument("--compare", metavar="FILE", help="confronta con una baseline salvata")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="rallentamento p50 tollerato (0.25 = +25%%)")
+    parser.add_argument("--worker", metavar="DB", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.reps)
+        return
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    for size in [s.strip() for s in args.sizes.split(",") if s.strip()]:
+        path = dataset(size, args.data_dir, args.seed)
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", path,
+                              "--reps", str(args.reps)], check=True, capture_output=True, text=True)
+        results[size] = json.loads(out.stdout.strip().splitlines()[-1])
+        print_table(size, results[size], (baseline or {}).get(size))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%d %H:%M"), "python": sys.version.split()[0],
+                       "reps": args.reps, "seed": args.seed, "results": results}, f, indent=2)
+        print(f"\nBaseline salvata in {args.save}")
+    if baseline is not None:
+        found = regressions(results, baseline, args.tolerance)
+        if found:
+            print("\nRegressioni rispetto alla baseline:")
+            for line in found:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("\nNessuna regressione rispetto alla baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Generatore di dati sintetici per i benchmark: ticket, chat, letture, utenti e cinema assegnati.
+
+Uso:
+    python bench/gen_data.py --tickets 100k --db /tmp/sigra_100k.db
+    python bench/gen_data.py --tickets 1m --db /tmp/sigra_1m.db --seed 7
+
+Crea lo schema con le migrazioni dell'app (flask db-upgrade + seed) e inserisce
+a blocchi con id espliciti, senza passare dall'ORM. Volumi per N ticket:
+- utenti: N/500 (minimo 10), ognuno con 1-4 cinema assegnati (10% senza assegnazioni)
+- ticket: 85% chiusi, distribuiti su 5 anni, urgenza 60/30/10, collegati a cinema_id
+- messaggi: in media 1,5 per ticket, con comment_count/last_comment_at coerenti
+- letture: l'autore ha letto il 70% dei ticket con messaggi, l'admin il 50%
+Lo stesso --seed produce sempre lo stesso DB.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+CHUNK = 10_000
+URGENZE = ["Non urgente", "Urgente", "Critico"]
+DIFETTI = ["Proiettore non si accende", "Audio assente", "Lampada da sostituire", "Server DCP in errore",
+           "Aria condizionata guasta", "Schermo macchiato", "Poltrona rotta", "Luci di sala bloccate",
+           "KDM scaduta", "Subwoofer distorto", "Rete TMS irraggiungibile", "Porta antipanico difettosa"]
+DETTAGLI = ["durante il primo spettacolo", "dopo il riavvio", "da ieri sera", "a intermittenza",
+            "con messaggio di errore", "segnalato dal pubblico", "al cambio bobina digitale", ""]
+RISPOSTE = ["Tecnico in arrivo", "Ricambio ordinato", "Riavviato, da monitorare", "Puoi mandare una foto?",
+            "Risolto, chiudo il ticket", "Il problema si ripresenta", "Sentito il fornitore", "Ok grazie"]
+
+
+def parse_size(value):
+    """'10k' -> 10000, '1m' -> 1000000."""
+    value = value.strip().lower()
+    mult = {"k": 1_000, "m": 1_000_000}.get(value[-1:], 1)
+    return int(float(value.rstrip("km")) * mult)
+
+
+def generate(tickets, seed=1, echo=print):
+    """Riempie il DB configurato in DATABASE_URL (va impostato prima di importare app)."""
+    from werkzeug.security import generate_password_hash
+    from app import (app, db, Problem, Comment, TicketRead, User, UserCinema, Cinema,
+                     problem_fingerprint, _upgrade_db, _seed_db)
+
+    rnd = random.Random(seed)
+    with app.app_context():
+        _upgrade_db()
+        _seed_db()
+        cinemas = db.session.execute(db.select(Cinema.id, Cinema.nome, Cinema.città, Cinema.num_sale)).all()
+        admin_id = db.session.execute(db.select(User.id).filter_by(username="admin")).scalar()
+
+        # Utenti: un solo hash condiviso (password "benchpass"), calcolarne migliaia costerebbe minuti
+        t0 = time.perf_counter()
+        n_users = max(10, tickets // 500)
+        pw_hash = generate_password_hash("benchpass")
+        first_uid = (db.session.execute(db.select(db.func.max(User.id))).scalar() or 0) + 1
+        users, assignments = [], []
+        for i in range(n_users):
+            uid = first_uid + i
+            users.append({"id": uid, "username": f"bench{i:05d}", "password_hash": pw_hash,
+                          "password_plain": "", "role": "user", "telefono": "", "email": ""})
+            if rnd.random() >= 0.1:
+                for c in rnd.sample(cinemas, rnd.randint(1, 4)):
+                    assignments.append({"user_id": uid, "cinema_id": c.id})
+        db.session.execute(db.insert(User), users)
+        if assignments:
+            db.session.execute(db.insert(UserCinema), assignments)
+        user_cinemas = {}
+        for a in assignments:
+            user_cinemas.setdefault(a["user_id"], []).append(a["cinema_id"])
+        cinema_by_id = {c.id: c for c in cinemas}
+        db.session.commit()
+        echo(f"  {n_users} utenti, {len(assignments)} assegnazioni cinema ({time.perf_counter() - t0:.1f} s)")
+
+        # Ticket, messaggi e letture a blocchi, con id espliciti per collegarli senza RETURNING
+        t0 = time.perf_counter()
+        start = datetime(2021, 1, 1)
+        span = (datetime(2026, 1, 1) - start).total_seconds()
+        next_pid = (db.session.execute(db.select(db.func.max(Problem.id))).scalar() or 0) + 1
+        next_cid = (db.session.execute(db.select(db.func.max(Comment.id))).scalar() or 0) + 1
+        n_comments = n_reads = 0
+        for base in range(0, tickets, CHUNK):
+            problems, comments, reads = [], [], []
+            for i in range(base, min(base + CHUNK, tickets)):
+                pid = next_pid + i
+                user = users[rnd.randrange(n_users)]
+                uid, autore = user["id"], user["username"]
+                cinema = cinema_by_id[rnd.choice(user_cinemas.get(uid) or [c.id for c in cinemas])]
+                sala = str(rnd.randint(1, max(1, cinema.num_sale)))
+                data_ora = start + timedelta(seconds=span * i / tickets + rnd.randint(0, 3600))
+                tipo = f"{rnd.choice(DIFETTI)} {rnd.choice(DETTAGLI)}".strip()
+                chiuso = rnd.random() < 0.85
+                chiuso_il = data_ora + timedelta(hours=rnd.randint(1, 240)) if chiuso else None
+
+                k = rnd.choices(range(7), weights=[30, 25, 20, 12, 7, 4, 2])[0]
+                t = data_ora
+                for _ in range(k):
+                    t += timedelta(minutes=rnd.randint(5, 600))
+                    comments.append({"id": next_cid, "problem_id": pid, "data_ora": t,
+                                     "autore": autore if rnd.random() < 0.5 else "admin",
+                                     "role": "user", "testo": rnd.choice(RISPOSTE)})
+                    next_cid += 1
+                if k:
+                    for reader, p_read in ((uid, 0.7), (admin_id, 0.5)):
+                        if rnd.random() < p_read:
+                            reads.append({"user_id": reader, "problem_id": pid, "last_read_at": t})
+                problems.append({
+                    "id": pid, "cinema": cinema.nome, "cinema_id": cinema.id, "città": cinema.città,
+                    "sala": sala, "tipo": tipo, "urgenza": rnd.choices(URGENZE, weights=[60, 30, 10])[0],
+                    "stato": "Chiuso" if chiuso else rnd.choice(["Aperto", "In corso"]),
+                    "chiuso_da": "admin" if chiuso else None, "chiuso_il": chiuso_il,
+                    "autore": autore, "data_ora": data_ora,
+                    "comment_count": k, "last_comment_at": t if k else None,
+                    "updated_at": max(t, chiuso_il or t),
+                    "fingerprint": problem_fingerprint(cinema.nome, sala, tipo, autore, data_ora),
+                })
+            db.session.execute(db.insert(Problem), problems)
+            if comments:
+                db.session.execute(db.insert(Comment), comments)
+            if reads:
+                db.session.execute(db.insert(TicketRead), reads)
+            db.session.commit()
+            n_comments += len(comments)
+            n_reads += len(reads)
+            echo(f"  {min(base + CHUNK, tickets)}/{tickets} ticket", end="\r")
+        echo(f"  {tickets} ticket, {n_comments} messaggi, {n_reads} letture ({time.perf_counter() - t0:.1f} s)")
+        if db.engine.dialect.name == "sqlite":
+            db.session.execute(db.text("ANALYZE"))
+            db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickets", default="10k", help="numero di ticket: 10k, 100k, 1m")
+    parser.add_argument("--db", required=True, help="file SQLite da creare")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        sys.exit(f"{args.db} esiste già: scegli un altro file o cancellalo")
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.abspath(args.db)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    generate(parse_size(args.tickets), args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Test di carico: molti operatori contemporanei contro un gunicorn locale, con p50/p99 per route.
+
+Uso:
+    python bench/load_test.py                                   # 30 utenti, 60 s, dataset 10k
+    python bench/load_test.py --users 60 --duration 120 --think 2
+    WEB_CONCURRENCY=4 GUNICORN_THREADS=8 python bench/load_test.py
+    python bench/load_test.py --database-url postgresql://localhost/sigra_load --json out.json
+
+Simula il cambio turno: tutti gli utenti (presi dalla tabella users del dataset, password
+"benchpass" come in bench/gen_data.py) fanno login insieme, poi ognuno ripete fino a
+--duration un mix di azioni con una pausa casuale media di --think secondi:
+    dashboard 35% · refresh /api/dashboard con ETag 25% · dettaglio ticket 20% ·
+    messaggio in chat 10% · cambio stato/urgenza 10%
+Il server è un gunicorn con gunicorn.conf.py (worker e thread da WEB_CONCURRENCY e
+GUNICORN_THREADS, come in produzione) avviato qui su una copia del dataset SQLite (il test
+scrive), oppure su --database-url già popolato (es. PostgreSQL riempito con gen_data.py).
+Con SQLite le scritture concorrenti si serializzano: per tarare worker e pool su numeri
+realistici usa PostgreSQL.
+Solo libreria standard lato client.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shlex
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+
+ACTIONS = [("dashboard", 35), ("api_dashboard", 25), ("ticket", 20), ("commento", 10), ("stato", 10)]
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None  # i 302 si misurano come risposta a sé, senza seguire il redirect
+
+
+class Operator:
+    """Un utente simulato: cookie di sessione propri e i propri ticket aperti."""
+
+    def __init__(self, base_url, username, ticket_ids, record):
+        self.base_url = base_url
+        self.username = username
+        self.ticket_ids = ticket_ids
+        self.record = record
+        self.etag = None
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+
+    def request(self, route, method, path, data=None, json_body=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers["Content-Type"] = "application/json"
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        t0 = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                resp.read()
+                status, resp_headers = resp.status, resp.headers
+        except urllib.error.HTTPError as e:
+            e.read()
+            status, resp_headers = e.code, e.headers
+        except (urllib.error.URLError, OSError):
+            status, resp_headers = 0, {}
+        self.record(route, time.perf_counter() - t0, status)
+        return status, resp_headers
+
+    def login(self):
+        status, _ = self.request("login", "POST", "/login",
+                                 data={"username": self.username, "password": "benchpass"})
+        return status == 302
+
+    def step(self, rnd):
+        action = rnd.choices([a for a, _ in ACTIONS], weights=[w for _, w in ACTIONS])[0]
+        if action != "dashboard" and action != "api_dashboard" and not self.ticket_ids:
+            action = "dashboard"
+        if action == "dashboard":
+            self.request("GET /dashboard", "GET", "/dashboard")
+        elif action == "api_dashboard":
+            headers = {"If-None-Match": self.etag} if self.etag else {}
+            status, resp_headers = self.request("GET /api/dashboard", "GET", "/api/dashboard", headers=headers)
+            if status in (200, 304):
+                self.etag = resp_headers.get("ETag") or self.etag
+        elif action == "ticket":
+            self.request("GET /problems/<id>", "GET", f"/problems/{rnd.choice(self.ticket_ids)}")
+        elif action == "commento":
+            self.request("POST /problems/<id>/comments", "POST",
+                         f"/problems/{rnd.choice(self.ticket_ids)}/comments",
+                         json_body={"testo": rnd.choice(["In arrivo", "Verificato", "Ancora guasto", "Ok"])})
+        else:
+            self.request("POST /problems/<id>/update", "POST", f"/problems/{rnd.choice(self.ticket_ids)}/update",
+                         data={"stato": rnd.choice(["Aperto", "In corso"]),
+                               "urgenza": rnd.choice(["Non urgente", "Urgente", "Critico"])})
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(base_url, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"gunicorn è terminato all'avvio (exit {proc.returncode})")
+        try:
+            urllib.request.urlopen(base_url + "/login", timeout=2).read()
+            return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.3)
+    sys.exit("gunicorn non risponde")
+
+
+def load_operators(database_url, n_users, seed):
+    """Utenti (non admin) e i loro ticket aperti, letti direttamente dal DB."""
+    from sqlalchemy import create_engine, text
+    engine = create_engine(database_url.replace("postgres://", "postgresql://", 1))
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT u.username, p.id FROM users u JOIN problems p ON p.autore = u.username "
+            "WHERE u.role = 'user' AND p.stato <> 'Chiuso'"
+        )).all()
+        usernames = list(conn.execute(text("SELECT username FROM users WHERE role = 'user' ORDER BY id")).scalars())
+    engine.dispose()
+    tickets = {}
+    for username, pid in rows:
+        tickets.setdefault(username, []).append(pid)
+    rnd = random.Random(seed)
+    chosen = rnd.sample(usernames, min(n_users, len(usernames)))
+    return [(u, tickets.get(u, [])[:200]) for u in chosen]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=30, help="operatori contemporanei")
+    parser.add_argument("--duration", type=float, default=60, help="secondi di carico dopo il login")
+    parser.add_argument("--think", type=float, default=1.0, help="pausa media tra due azioni (s), 0 = nessuna")
+    parser.add_argument("--tickets", default="10k", help="dimensione del dataset generato (vedi gen_data.py)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "sigra_bench_data"))
+    parser.add_argument("--database-url", help="DB già popolato (utenti bench*, password benchpass) al posto della copia SQLite")
+    parser.add_argument("--gunicorn-args", default="", help="opzioni extra per gunicorn (worker, thread…)")
+    parser.add_argument("--json", metavar="FILE", help="salva anche i risultati in JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="sigra_load_")
+    if args.database_url:
+        database_url = args.database_url
+    else:
+        source = os.path.join(args.data_dir, f"sigra_{args.tickets}_s{args.seed}.db")
+        if not os.path.exists(source):
+            os.makedirs(args.data_dir, exist_ok=True)
+            subprocess.run([sys.executable, os.path.join(HERE, "gen_data.py"), "--tickets", args.tickets,
+                            "--db", source, "--seed", str(args.seed)], check=True)
+        db_path = os.path.join(workdir, "load.db")
+        shutil.copyfile(source, db_path)
+        database_url = "sqlite:///" + db_path
+
+    operators = load_operators(database_url, args.users, args.seed)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, DATABASE_URL=database_url, EXPORT_CACHE_DIR=os.path.join(workdir, "export"),
+               SLOW_QUERY_MS=os.environ.get("SLOW_QUERY_MS", "0"))
+    cmd = ["gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"), "app:app", "--bind", f"127.0.0.1:{port}", *shlex.split(args.gunicorn_args)]
+    log = open(os.path.join(workdir, "gunicorn.log"), "w")
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    samples = {}
+    samples_lock = threading.Lock()
+
+    def record(route, elapsed, status):
+        with samples_lock:
+            samples.setdefault(route, []).append((elapsed, status))
+
+    try:
+        wait_ready(base_url, proc)
+        print(f"gunicorn pronto su {base_url} ({' '.join(cmd[4:]) or 'default'}); "
+              f"{len(operators)} operatori, {args.duration:.0f} s, pausa media {args.think} s")
+
+        clients = [Operator(base_url, username, tickets, record) for username, tickets in operators]
+        start_barrier = threading.Barrier(len(clients) + 1)
+        stop_at = [0.0]
+
+        def run(client, seed):
+            rnd = random.Random(seed)
+            start_barrier.wait()
+            if not client.login():
+                return
+            while time.monotonic() < stop_at[0]:
+                client.step(rnd)
+                if args.think > 0:
+                    time.sleep(rnd.expovariate(1 / args.think))
+
+        threads = [threading.Thread(target=run, args=(c, args.seed + i), daemon=True)
+                   for i, c in enumerate(clients)]
+        for t in threads:
+            t.start()
+        t0 = time.monotonic()
+        stop_at[0] = t0 + args.duration
+        start_barrier.wait()  # login di tutti nello stesso istante, come al cambio turno
+        for t in threads:
+            t.join()
+        wall = time.monotonic() - t0
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+
+    report = {}
+    total = errors = 0
+    print(f"\n{'route':<32} {'richieste':>9} {'errori':>7} {'req/s':>7} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8}")
+    for route, values in sorted(samples.items()):
+        times = sorted(v[0] * 1000 for v in values)
+        n_err = sum(1 for _, status in values if status == 0 or status >= 400)
+        total += len(values)
+        errors += n_err
+        report[route] = {"requests": len(values), "errors": n_err, "rps": round(len(values) / wall, 2),
+                         "p50_ms": round(percentile(times, 50), 1), "p90_ms": round(percentile(times, 90), 1),
+                         "p99_ms": round(percentile(times, 99), 1), "max_ms": round(times[-1], 1),
+                         "mean_ms": round(statistics.fmean(times), 1)}
+        r = report[route]
+        print(f"{route:<32} {r['requests']:>9} {r['errors']:>7} {r['rps']:>7.1f} {r['p50_ms']:>8.1f} "
+              f"{r['p90_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['max_ms']:>8.1f}")
+    print(f"\nTotale: {total} richieste in {wall:.1f} s = {total / wall:.1f} req/s, {errors} errori")
+    print(f"Log di gunicorn: {os.path.join(workdir, 'gunicorn.log')}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"gunicorn": cmd[4:], "users": len(operators), "duration_s": round(wall, 1),
+                       "think_s": args.think, "total_rps": round(total / wall, 2), "errors": errors,
+                       "routes": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
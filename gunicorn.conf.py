@@ -0,0 +1,52 @@
+# gunicorn.conf.py
+# Configurazione di produzione: gunicorn -c gunicorn.conf.py app:app
+# Tutto si regola con variabili d'ambiente, senza toccare render.yaml/Procfile.
+#
+# Connessioni verso Postgres ≈ WEB_CONCURRENCY × (DB_POOL_SIZE + DB_MAX_OVERFLOW):
+# il pool di ogni worker è dimensionato in app.py sui thread del worker.
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Processi × thread: i thread coprono l'attesa su DB e client lenti (chat, export),
+# i processi aggirano il GIL per la CPU (template, Excel)
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+# app.py legge lo stesso valore per dimensionare il pool SQLAlchemy
+os.environ["GUNICORN_THREADS"] = str(threads)
+# Richieste che restano in attesa occupano un thread ciascuna: il long-poll della chat
+# (default) tiene un thread per ~CHAT_LONGPOLL_SECONDS ogni CHAT_LONGPOLL_SECONDS +
+# CHAT_POLL_INTERVAL secondi per scheda ticket aperta. Con CHAT_SSE=1 ogni scheda tiene un
+# thread per tutto lo stream: servono workers × threads > schede aperte + richieste normali,
+# altrimenti poche schede bloccano dashboard e login.
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))  # > CHAT_STREAM_SECONDS con CHAT_SSE=1
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Riciclo periodico dei worker contro la crescita di memoria; il jitter evita
+# che ripartano tutti nello stesso momento
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+
+# L'app (Flask, SQLAlchemy, openpyxl, template) si importa una volta nel master e i
+# worker la ereditano col fork: avvio più rapido e memoria condivisa
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG") or None  # "-" = stdout
+errorlog = "-"
+
+
+def when_ready(server):
+    server.log.info("Pronto: %s worker %s × %s thread", workers, worker_class, threads)
+
+
+def post_fork(server, worker):
+    # Con preload_app il master può aver aperto connessioni: i socket non vanno condivisi
+    # tra processi, ogni worker riparte con un pool vuoto
+    if preload_app:
+        from app import app, db
+        with app.app_context():
+            db.engine.dispose(close=False)
@@ -2,8 +2,11 @@
 # Questo file esiste solo per compatibilità con Render
 # in modo che il comando "gunicorn main:app" trovi l'applicazione Flask.
 
-from app import app
+from app import app, _upgrade_db, _seed_db
 
 # Se vuoi testare in locale, puoi avviarlo anche direttamente:
 if __name__ == "__main__":
+    with app.app_context():
+        _upgrade_db()
+        _seed_db()
     app.run(host="0.0.0.0", port=5000, debug=True)
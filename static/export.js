@@ -0,0 +1,39 @@
+// Export Excel in background: accoda il job, fa polling dello stato e scarica
+// il file quando è pronto. Senza JS il link resta un download sincrono.
+document.addEventListener("click", function (ev) {
+  const link = ev.target.closest("a[data-export]");
+  if (!link) return;
+  ev.preventDefault();
+  if (link.dataset.busy) return;
+  link.dataset.busy = "1";
+  const label = link.innerHTML;
+  link.innerHTML = "⏳ Preparazione…";
+
+  const done = function (msg) {
+    delete link.dataset.busy;
+    link.innerHTML = label;
+    if (msg) alert(msg);
+  };
+  const poll = function (job) {
+    if (job.status === "done") {
+      window.location = job.download_url;
+      done();
+    } else if (job.status === "error") {
+      done("Export non riuscito: " + (job.error || "errore sconosciuto"));
+    } else {
+      setTimeout(function () {
+        fetch("/export/jobs/" + job.job_id, { credentials: "same-origin" })
+          .then(function (r) { return r.json(); })
+          .then(poll)
+          .catch(function () { done("Export non riuscito."); });
+      }, 1000);
+    }
+  };
+
+  const body = new FormData();
+  body.append("foglio", link.dataset.export);
+  fetch("/export/jobs", { method: "POST", body: body, credentials: "same-origin" })
+    .then(function (r) { return r.json(); })
+    .then(poll)
+    .catch(function () { window.location = link.href; });
+});